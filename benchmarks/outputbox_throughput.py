@@ -0,0 +1,351 @@
+#####################################################################
+#                                                                   #
+# outputbox_throughput.py                                           #
+#                                                                   #
+# Copyright 2013, Christopher Billington, Philip Starkey            #
+#                                                                   #
+# This file is part of the qtutils project                          #
+# (see https://github.com/philipstarkey/qtutils )                   #
+# and is licensed under the 2-clause, or 3-clause, BSD License.     #
+# See the license.txt file in the root of the project               #
+# for the full license.                                             #
+#                                                                   #
+#####################################################################
+"""Benchmark of OutputBox throughput, latency and main thread load under a range of
+workloads, using the offscreen Qt platform so that no display is required.
+
+Usage: python benchmarks/outputbox_throughput.py [--json] [--qt LIB [LIB ...]]
+           [--workload NAME [NAME ...]] [--scale X] [--ring] [--timeout SECONDS]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import importlib.util
+import subprocess
+
+import zmq
+
+QT_LIBS = ['PyQt5', 'PyQt6', 'PySide6']
+
+# Lines beginning with this are timestamps from which latency is measured:
+PROBE = 'probe@'
+# How many writes between probes:
+PROBE_INTERVAL = 1000
+# Written by each writer once it is done:
+END = 'end@'
+
+THREAD = 'thread'
+PROCESS = 'process'
+
+
+def small_lines(write, count):
+    for i in range(count):
+        write('%08d: the quick brown fox jumps over the lazy dog\n' % i)
+        if i % PROBE_INTERVAL == 0:
+            write('%s%r\n' % (PROBE, time.monotonic()))
+
+
+def huge_writes(write, count):
+    # 4MB per write:
+    block = ''.join('%08d: %s\n' % (i, 'x' * 70) for i in range(52429))
+    for i in range(count):
+        write(block)
+        write('%s%r\n' % (PROBE, time.monotonic()))
+
+
+def carriage_returns(write, count):
+    # Progress bar updates, with a line of their own every so often:
+    for i in range(count):
+        write('progress: %08d [%-40s]\r' % (i, '#' * (i % 41)))
+        if i % PROBE_INTERVAL == 0:
+            write('%s%r\n' % (PROBE, time.monotonic()))
+
+
+def many_formats(write, count):
+    charformats = [
+        ('#%06x' % (i * 0x0f1d37 & 0xffffff), bool(i & 1), bool(i & 2))
+        for i in range(500)
+    ]
+    for i in range(count):
+        charformat = charformats[i % len(charformats)]
+        write('%08d: the quick brown fox jumps over the lazy dog\n' % i, charformat)
+        if i % PROBE_INTERVAL == 0:
+            write('%s%r\n' % (PROBE, time.monotonic()))
+
+
+# name: (function, number of writers, kind of writer, writes per writer at scale 1):
+WORKLOADS = {
+    'small_lines': (small_lines, 1, THREAD, 200000),
+    'huge_writes': (huge_writes, 1, THREAD, 10),
+    'carriage_returns': (carriage_returns, 1, THREAD, 500000),
+    'many_formats': (many_formats, 1, THREAD, 100000),
+    'many_threads': (small_lines, 16, THREAD, 12500),
+    'many_processes': (small_lines, 8, PROCESS, 25000),
+}
+
+
+def run_writer(workload, count, write):
+    """Run the workload, calling write(text, charformat) for each write, where
+    charformat is None or a (color, bold, italic) tuple. Return the number of lines
+    and bytes written. All text is ASCII, so its length is its size in bytes."""
+    totals = {'lines': 0, 'bytes': 0}
+
+    def counting_write(text, charformat=None):
+        write(text, charformat)
+        totals['lines'] += text.count('\n')
+        totals['bytes'] += len(text)
+
+    WORKLOADS[workload][0](counting_write, count)
+    counting_write(END + '\n')
+    return totals
+
+
+def writer_process(workload, count, endpoint):
+    """Run the workload in this process, sending to the OutputBox at the given
+    endpoint, and print the totals written"""
+    sock = zmq.Context.instance().socket(zmq.PUSH)
+    sock.connect(endpoint)
+
+    def write(text, charformat=None):
+        if charformat is None:
+            frame = b'stdout'
+        else:
+            frame = repr(charformat).encode('utf8')
+        sock.send_multipart([frame, text.encode('utf8')])
+
+    totals = run_writer(workload, count, write)
+    # Wait for everything to be sent before exiting:
+    sock.close(linger=-1)
+    print(json.dumps(totals))
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, or None if unavailable"""
+    try:
+        import resource
+    except ImportError:
+        # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere:
+    return rss if sys.platform == 'darwin' else 1024 * rss
+
+
+def percentiles(values, points=(50, 90, 99, 100)):
+    values = sorted(values)
+    if not values:
+        return {'p%d' % p: None for p in points}
+    return {
+        'p%d' % p: values[min(len(values) - 1, len(values) * p // 100)] for p in points
+    }
+
+
+def run_workload(workload, scale, ring, timeout):
+    """Run the workload against an OutputBox in this process and return the results"""
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from qtutils.qt import QT_ENV
+    from qtutils.qt.QtCore import QTimer
+    from qtutils.qt.QtWidgets import QApplication, QWidget, QVBoxLayout
+    from qtutils.outputbox import OutputBox, RingBufferOutputBox
+
+    _, n_writers, kind, count = WORKLOADS[workload]
+    count = max(1, int(count * scale))
+
+    app = QApplication(sys.argv)
+    window = QWidget()
+    layout = QVBoxLayout(window)
+    if ring:
+        box = RingBufferOutputBox(layout)
+    else:
+        box = OutputBox(layout)
+    window.resize(800, 600)
+    window.show()
+
+    latencies = []
+    state = {'ends': 0, 'end_time': None, 'main_cpu': None, 'overhead': 0.0}
+    apply_plan = box._apply_plan
+
+    def measuring_apply_plan(ops):
+        apply_plan(ops)
+        now = time.monotonic()
+        start_cpu = time.thread_time()
+        for _, text, _ in ops:
+            if text.startswith(PROBE):
+                latencies.append(now - float(text[len(PROBE):]))
+            elif text == END:
+                state['ends'] += 1
+        # Don't count the time spent measuring as time spent by the OutputBox:
+        state['overhead'] += time.thread_time() - start_cpu
+        if state['ends'] == n_writers and state['end_time'] is None:
+            state['end_time'] = now
+            state['main_cpu'] = time.thread_time() - state['overhead']
+            app.quit()
+
+    box._apply_plan = measuring_apply_plan
+
+    totals = []
+    if kind == THREAD:
+        def write(text, charformat=None):
+            if charformat is None:
+                box.write(text)
+            else:
+                box.write(text, *charformat)
+
+        def run():
+            totals.append(run_writer(workload, count, write))
+
+        writers = [threading.Thread(target=run, daemon=True) for _ in range(n_writers)]
+    else:
+        cmd = [sys.executable, __file__, '--writer', workload]
+        cmd += ['--count', str(count), '--endpoint', box.endpoint]
+
+    QTimer.singleShot(int(1000 * timeout), app.quit)
+    start_cpu = time.thread_time()
+    start_time = time.monotonic()
+    if kind == THREAD:
+        for writer in writers:
+            writer.start()
+    else:
+        writers = [subprocess.Popen(cmd, stdout=subprocess.PIPE) for _ in range(n_writers)]
+    app.exec() if hasattr(app, 'exec') else app.exec_()
+
+    timed_out = state['end_time'] is None
+    if timed_out:
+        end_time = time.monotonic()
+        main_cpu = time.thread_time()
+    else:
+        end_time = state['end_time']
+        main_cpu = state['main_cpu']
+    elapsed = end_time - start_time
+    main_cpu -= start_cpu
+
+    if kind == THREAD:
+        for writer in writers:
+            writer.join(timeout=0 if timed_out else None)
+    else:
+        for writer in writers:
+            if timed_out:
+                writer.kill()
+            stdout, _ = writer.communicate()
+            if stdout:
+                totals.append(json.loads(stdout))
+    box.shutdown()
+
+    lines = sum(total['lines'] for total in totals)
+    n_bytes = sum(total['bytes'] for total in totals)
+    return {
+        'qt': QT_ENV,
+        'timed_out': timed_out,
+        'elapsed': elapsed,
+        'lines': lines,
+        'bytes': n_bytes,
+        'lines_per_second': lines / elapsed,
+        'mb_per_second': n_bytes / elapsed / 1e6,
+        'latency': percentiles(latencies),
+        'latency_samples': len(latencies),
+        'main_thread_cpu': main_cpu,
+        'main_thread_cpu_share': main_cpu / elapsed,
+        'peak_rss': peak_rss(),
+        'dropped_lines': box.dropped_lines,
+    }
+
+
+def time_workload(qt_lib, workload, scale, ring, timeout):
+    """Run the workload in a fresh subprocess using the given Qt library, so that
+    memory use and Qt state from one run does not affect another"""
+    cmd = [sys.executable, __file__, '--run', workload, '--scale', str(scale)]
+    cmd += ['--timeout', str(timeout)]
+    if ring:
+        cmd.append('--ring')
+    env = dict(os.environ, QT_ENV=qt_lib, QT_QPA_PLATFORM='offscreen')
+    return json.loads(subprocess.check_output(cmd, env=env))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--json', action='store_true', help="output results as JSON")
+    parser.add_argument(
+        '--qt',
+        nargs='+',
+        choices=QT_LIBS,
+        help="Qt libraries to benchmark. Defaults to all that are installed",
+    )
+    parser.add_argument(
+        '--workload',
+        nargs='+',
+        choices=list(WORKLOADS),
+        default=list(WORKLOADS),
+        help="workloads to run. Defaults to all of them",
+    )
+    parser.add_argument(
+        '--scale', type=float, default=1.0, help="multiplier for the amount of output"
+    )
+    parser.add_argument(
+        '--ring', action='store_true', help="benchmark RingBufferOutputBox instead"
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=120, help="maximum time for each workload"
+    )
+    parser.add_argument('--run', help="run a single workload and print the result")
+    parser.add_argument('--writer', help=argparse.SUPPRESS)
+    parser.add_argument('--count', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--endpoint', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.writer is not None:
+        writer_process(args.writer, args.count, args.endpoint)
+        return
+
+    if args.run is not None:
+        print(json.dumps(run_workload(args.run, args.scale, args.ring, args.timeout)))
+        return
+
+    qt_libs = args.qt
+    if qt_libs is None:
+        qt_libs = [lib for lib in QT_LIBS if importlib.util.find_spec(lib) is not None]
+
+    results = {
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'box': 'RingBufferOutputBox' if args.ring else 'OutputBox',
+        'scale': args.scale,
+        'results': {
+            qt_lib: {
+                workload: time_workload(
+                    qt_lib, workload, args.scale, args.ring, args.timeout
+                )
+                for workload in args.workload
+            }
+            for qt_lib in qt_libs
+        },
+    }
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+    print(f"Python {results['python']}, {results['box']}, scale {args.scale}")
+    for qt_lib, qt_results in results['results'].items():
+        print(f"\n{qt_lib}:")
+        print(
+            f"{'workload':>18} {'lines/s':>10} {'MB/s':>7} {'p50 ms':>8} {'p99 ms':>8}"
+            f" {'main CPU':>9} {'RSS MB':>7}"
+        )
+        for workload, result in qt_results.items():
+            latency = {
+                point: float('nan') if value is None else 1000 * value
+                for point, value in result['latency'].items()
+            }
+            rss = float('nan') if result['peak_rss'] is None else result['peak_rss'] / 1e6
+            print(
+                f"{workload:>18} {result['lines_per_second']:10.0f}"
+                f" {result['mb_per_second']:7.2f} {latency['p50']:8.1f}"
+                f" {latency['p99']:8.1f} {100 * result['main_thread_cpu_share']:8.1f}%"
+                f" {rss:7.1f}" + ("  (timed out)" if result['timed_out'] else "")
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#####################################################################
+#                                                                   #
+# qtlock_enforce.py                                                 #
+#                                                                   #
+# Copyright 2013, Christopher Billington, Philip Starkey            #
+#                                                                   #
+# This file is part of the qtutils project                          #
+# (see https://github.com/philipstarkey/qtutils )                   #
+# and is licensed under the 2-clause, or 3-clause, BSD License.     #
+# See the license.txt file in the root of the project               #
+# for the full license.                                             #
+#                                                                   #
+#####################################################################
+"""Benchmark of the overhead of each qtlock enforcement mode on a numerical worker
+thread, relative to running with no enforcement at all.
+
+Usage: python benchmarks/qtlock_enforce.py [--json] [--repeats N] [--iterations N]
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import threading
+import subprocess
+
+# Don't let importing qtutils enable enforcement; we do it ourselves:
+os.environ['QTUTILS_QTLOCK_ENFORCE'] = 'off'
+
+from qtutils.qt import QT_ENV
+from qtutils.locking import qtlock
+
+
+def helper(x):
+    return x * 0.5 + 1
+
+
+def workload(iterations):
+    # A mixture of calls to Python and C functions, none of them Qt methods:
+    total = 0.0
+    values = []
+    for i in range(iterations):
+        total += math.sqrt(i) + abs(-i) + helper(i)
+        values.append(total)
+        if len(values) > 100:
+            values.clear()
+    return total
+
+
+def time_in_thread(iterations):
+    # Enforcement in 'profile' mode only applies to threads created after
+    # it was enabled, so use a new thread each time:
+    result = {}
+
+    def run():
+        start_time = time.perf_counter()
+        workload(iterations)
+        result['time'] = time.perf_counter() - start_time
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    return result['time']
+
+
+def time_mode(mode, iterations, repeats):
+    """Time the workload with the given enforcement mode in a fresh subprocess. Once
+    a profile function has been installed, some of its overhead remains even after it
+    is removed, so modes cannot be compared fairly within one process."""
+    cmd = [sys.executable, __file__, '--mode', mode]
+    cmd += ['--iterations', str(iterations), '--repeats', str(repeats)]
+    return float(subprocess.check_output(cmd))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--json', action='store_true', help="output results as JSON")
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--iterations', type=int, default=200000)
+    parser.add_argument('--mode', help="time a single mode and print the result")
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        qtlock.enforce(mode=args.mode)
+        # Best of several runs, to reduce noise:
+        print(min(time_in_thread(args.iterations) for _ in range(args.repeats)))
+        return
+
+    modes = ['off', 'profile']
+    if hasattr(sys, 'monitoring'):
+        modes.append('monitoring')
+
+    times = {mode: time_mode(mode, args.iterations, args.repeats) for mode in modes}
+
+    results = {
+        'python': sys.version.split()[0],
+        'qt': QT_ENV,
+        'iterations': args.iterations,
+        'modes': {
+            mode: {'time': times[mode], 'relative': times[mode] / times['off']}
+            for mode in modes
+        },
+    }
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print(f"Python {results['python']}, {QT_ENV}, {args.iterations} iterations")
+        for mode, result in results['modes'].items():
+            print(f"{mode:>12}: {1000 * result['time']:8.1f} ms  ({result['relative']:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -13,11 +13,13 @@
 #####################################################################
 from .__version__ import __version__
 from qtutils.qt.QtCore import qInstallMessageHandler
-from qtutils.locking import qtlock
+from qtutils.locking import qtlock, default_enforce_mode
 
-qtlock.enforce()
+qtlock.enforce(mode=default_enforce_mode())
 
-from qtutils.invoke_in_main import inmain, inmain_later, inthread, inmain_decorator
+from qtutils.invoke_in_main import (
+    inmain, inmain_later, inmain_async, inthread, inthread_pool, inmain_decorator
+)
 
 from qtutils.qsettings_wrapper import QSettingsWrapper
 from qtutils.disconnect_contextmanager import DisconnectContextManager
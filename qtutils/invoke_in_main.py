@@ -12,13 +12,241 @@
 #                                                                   #
 #####################################################################
 
+import os
 import sys
-from queue import Queue
+import math
+import time
+import queue
 
 import threading
 import functools
+import collections
+import logging
+import asyncio
+import selectors
+import concurrent.futures
 
-from qtutils.qt.QtCore import QEvent, QObject, QCoreApplication, QTimer, QThread
+from qtutils.qt.QtCore import (
+    QEvent, QObject, QCoreApplication, QTimer, QThread, QSocketNotifier
+)
+
+
+PENDING = 'PENDING'
+RUNNING = 'RUNNING'
+CANCELLED = 'CANCELLED'
+FINISHED = 'FINISHED'
+
+# Priorities for calls in the main thread. The values are those of the corresponding
+# Qt.EventPriority, which is used to post the event that wakes the Caller:
+HIGH_PRIORITY = 1
+NORMAL_PRIORITY = 0
+LOW_PRIORITY = -1
+PRIORITIES = (HIGH_PRIORITY, NORMAL_PRIORITY, LOW_PRIORITY)
+
+# How often, in seconds, the Qt event loop iterates the main thread's asyncio event loop
+# whilst coroutines scheduled with run_coroutine_in_main() are running, if it is of a
+# kind that cannot be waited on without polling, such as the ProactorEventLoop:
+ASYNCIO_POLL_INTERVAL = 0.002
+
+# Protects the state transitions of all Futures. Critical sections are tiny, so one
+# lock shared between them is cheaper than allocating one per Future:
+_future_state_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+class Future(object):
+    """A lightweight object holding the eventual result of a function call, with the
+    same methods as :code:`concurrent.futures.Future`.
+
+    Unlike a :code:`concurrent.futures.Future` or a :code:`queue.Queue`, creating one
+    allocates only a single lock, which is held until the result is available and which
+    waiting threads briefly acquire to be woken.
+
+    It is not a :code:`concurrent.futures.Future` however, and functions that rely on
+    the internals of one, such as :code:`concurrent.futures.wait()`,
+    :code:`concurrent.futures.as_completed()` and :code:`asyncio.wrap_future()`, do not
+    accept it. Pass them the result of :code:`as_concurrent()` instead.
+
+    For backward compatibility with code written when :code:`inmain_later` returned a
+    Python Queue, the methods :code:`get()`, :code:`get_nowait()` and :code:`empty()`
+    are also provided, and behave like those of a Queue holding the single item
+    :code:`[result, exception]`, where :code:`exception=[type,value,traceback]`. Unlike
+    a Queue, the item is not removed by reading it."""
+
+    __slots__ = ('_state', '_result', '_exc_info', '_done_lock', '_callbacks')
+
+    def __init__(self):
+        self._state = PENDING
+        self._result = None
+        self._exc_info = None
+        self._callbacks = None
+        self._done_lock = threading.Lock()
+        self._done_lock.acquire()
+
+    def __repr__(self):
+        return '<%s at %#x state=%s>' % (self.__class__.__name__, id(self), self._state)
+
+    def cancel(self):
+        """Cancel the call if it has not started running. Returns whether the call
+        is now cancelled."""
+        with _future_state_lock:
+            if self._state == CANCELLED:
+                return True
+            if self._state != PENDING:
+                return False
+            self._state = CANCELLED
+        self._finish()
+        return True
+
+    def cancelled(self):
+        """Return whether the call was cancelled."""
+        return self._state == CANCELLED
+
+    def running(self):
+        """Return whether the call is currently running."""
+        return self._state == RUNNING
+
+    def done(self):
+        """Return whether the call was cancelled or has finished running."""
+        return self._state in (CANCELLED, FINISHED)
+
+    def _wait(self, timeout):
+        if self._state in (CANCELLED, FINISHED):
+            return True
+        if self._done_lock.acquire(True, -1 if timeout is None else timeout):
+            # Let the next waiting thread, if any, through:
+            self._done_lock.release()
+            return True
+        return False
+
+    def result(self, timeout=None):
+        """Return the return value of the call, waiting up to :code:`timeout` seconds
+        for it if it is not yet done. Raises the exception raised by the call, if any,
+        :code:`concurrent.futures.CancelledError` if the call was cancelled, or
+        :code:`concurrent.futures.TimeoutError` if the timeout expired."""
+        if not self._wait(timeout):
+            raise concurrent.futures.TimeoutError()
+        if self._state == CANCELLED:
+            raise concurrent.futures.CancelledError()
+        if self._exc_info is not None:
+            type, value, traceback = self._exc_info
+            raise value.with_traceback(traceback)
+        return self._result
+
+    def exception(self, timeout=None):
+        """Return the exception raised by the call, or None if it completed without
+        raising, waiting up to :code:`timeout` seconds for it if it is not yet done."""
+        if not self._wait(timeout):
+            raise concurrent.futures.TimeoutError()
+        if self._state == CANCELLED:
+            raise concurrent.futures.CancelledError()
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, fn, in_main=False):
+        """Call :code:`fn(future)` when the call is cancelled or finishes. If it
+        already has, :code:`fn` is called immediately. Otherwise it is called in
+        the thread that completes the Future. If :code:`in_main=True`, :code:`fn` is
+        instead always called in the main thread, queued in the same way as
+        :func:`qtutils.invoke_in_main.inmain_later`."""
+        if in_main:
+            callback = fn
+
+            def fn(future):
+                _post_call(callback, (future,), {}, True, NORMAL_PRIORITY)
+
+        with _future_state_lock:
+            if self._state not in (CANCELLED, FINISHED):
+                if self._callbacks is None:
+                    self._callbacks = []
+                self._callbacks.append(fn)
+                return
+        self._invoke_callback(fn)
+
+    def as_concurrent(self):
+        """Return a :code:`concurrent.futures.Future` that is completed or cancelled
+        along with this one. Cancelling it also cancels this Future, if the call has not
+        yet started."""
+        future = concurrent.futures.Future()
+
+        def on_cancel(future):
+            if future.cancelled():
+                self.cancel()
+
+        future.add_done_callback(on_cancel)
+        self.add_done_callback(lambda source: _copy_future_state(source, future))
+        return future
+
+    def set_running_or_notify_cancel(self):
+        """Mark the Future as running. Returns False if it was cancelled, in which case
+        the call should not be made."""
+        with _future_state_lock:
+            if self._state == CANCELLED:
+                return False
+            if self._state != PENDING:
+                raise RuntimeError('Future in unexpected state: %s' % self._state)
+            self._state = RUNNING
+        return True
+
+    def set_result(self, result):
+        """Set the return value of the call and mark the Future as done."""
+        self._set(result, None)
+
+    def set_exception(self, exception):
+        """Set the exception raised by the call and mark the Future as done."""
+        self._set(None, (type(exception), exception, exception.__traceback__))
+
+    def _set(self, result, exc_info):
+        with _future_state_lock:
+            if self._state in (CANCELLED, FINISHED):
+                raise RuntimeError('Future in unexpected state: %s' % self._state)
+            self._result = result
+            self._exc_info = exc_info
+            self._state = FINISHED
+        self._finish()
+
+    def _finish(self):
+        self._done_lock.release()
+        callbacks = self._callbacks
+        self._callbacks = None
+        if callbacks is not None:
+            for fn in callbacks:
+                self._invoke_callback(fn)
+
+    def _invoke_callback(self, fn):
+        try:
+            fn(self)
+        except Exception:
+            logger.exception('exception calling callback for %r', self)
+
+    # The Queue interface, for backward compatibility:
+
+    def put(self, item):
+        """Set the result of the call from a :code:`[result, exception]` pair, where
+        :code:`exception=[type,value,traceback]` or None."""
+        result, exc_info = item
+        self._set(result, exc_info)
+
+    def get(self, block=True, timeout=None):
+        """Wait for the call to complete and return :code:`[result, exception]`, where
+        :code:`exception=[type,value,traceback]` or None. Raises :code:`queue.Empty` if
+        :code:`block` is False and the call is not done, or if the timeout expires."""
+        if not self._wait(timeout if block else 0):
+            raise queue.Empty
+        if self._state == CANCELLED:
+            exception = concurrent.futures.CancelledError()
+            return [None, (type(exception), exception, None)]
+        return [self._result, self._exc_info]
+
+    def get_nowait(self):
+        """Equivalent to :code:`get(False)`."""
+        return self.get(False)
+
+    def empty(self):
+        """Return True if the call is not yet done."""
+        return not self.done()
 
 
 class CallEvent(QEvent):
@@ -31,17 +259,221 @@ class CallEvent(QEvent):
         self.args = args
         self.kwargs = kwargs
         self._returnval = queue
+        # The thread that requested the call, for diagnostics:
+        self.thread_ident = threading.get_ident()
+        # Key identifying calls that may be coalesced with this one, or None:
+        self._coalesce_key = None
         # Whether to raise exceptions in the main thread or store them
         # for raising in the calling thread:
         self._exceptions_in_main = exceptions_in_main
 
 
+class CallStats(object):
+    """Accumulated statistics about calls made by the Caller to one function."""
+
+    __slots__ = ('calls', 'queue_wait_total', 'queue_wait_max', 'exec_time_total',
+                 'exec_time_max', 'exceptions')
+
+    def __init__(self):
+        self.calls = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.exec_time_total = 0.0
+        self.exec_time_max = 0.0
+        self.exceptions = 0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def _qualified_name(fn):
+    """A name identifying a function for the purposes of call statistics"""
+    while isinstance(fn, functools.partial):
+        fn = fn.func
+    qualname = getattr(fn, '__qualname__', None)
+    if qualname is None:
+        qualname = type(fn).__qualname__
+    module = getattr(fn, '__module__', None)
+    if module is None:
+        return qualname
+    return '%s.%s' % (module, qualname)
+
+
+class WakeupEvent(QEvent):
+    """An event requesting the Caller to run all pending function calls."""
+    EVENT_TYPE = QEvent.Type(QEvent.registerEventType())
+
+    def __init__(self):
+        QEvent.__init__(self, self.EVENT_TYPE)
+
+
 class Caller(QObject):
-    """An event handler which calls the function held within a CallEvent."""
+    """An event handler which calls the functions held within CallEvents.
+
+    CallEvents are not posted to the Qt event loop one by one. Instead they are
+    appended to a queue of pending calls, and a single WakeupEvent is posted whenever
+    that queue goes from empty to non-empty. Processing the WakeupEvent then runs the
+    calls pending at that time in the order they were requested. This keeps the Qt event queue
+    short when many calls are made from threads in quick succession. CallEvents
+    posted directly to the Caller with QCoreApplication.postEvent() are also
+    supported.
+
+    There is a separate queue for each priority. Pending calls of a higher priority
+    are always run before those of a lower priority, and calls of the same priority
+    are run in the order they were requested. The WakeupEvent is posted with the
+    priority of the highest priority call pending, so that high priority calls are
+    also not kept waiting behind other events in the Qt event queue.
+
+    If a time budget is set, the Caller stops running pending calls once the budget
+    is used up, and posts another WakeupEvent to carry on from where it left off. In
+    between, the Qt event loop processes other events, such as paint and input events,
+    so that the GUI remains responsive whilst a large backlog of calls is run.
+
+    A call may be posted with a coalesce key. Whilst a call with the same key is still
+    pending, posting another one replaces the function and arguments of the pending
+    call rather than queueing a new one, and both callers are given the same Future."""
+
+    def __init__(self):
+        QObject.__init__(self)
+        self.pending = {priority: collections.deque() for priority in PRIORITIES}
+        self.lock = threading.Lock()
+        # The priority of the WakeupEvent that has been posted and has not yet drained
+        # the queues, or None if there is no such WakeupEvent:
+        self.wakeup_priority = None
+        # Pending CallEvents that may be coalesced with subsequent calls, by key:
+        self.coalescable = {}
+        # Maximum time in seconds to spend running pending calls before yielding to the
+        # Qt event loop, or None for no limit:
+        self.budget = None
+        # The CallEvent currently being processed, for diagnostics:
+        self.current_event = None
+        # Dict of CallStats by qualified function name, or None if not collecting
+        # statistics:
+        self.stats = None
+        self.stats_lock = threading.Lock()
+
+    def post(self, event, priority=NORMAL_PRIORITY, coalesce_key=None):
+        """Queue a CallEvent to be processed by the mainloop. If coalesce_key is not
+        None and a call with the same key is pending, its function and arguments are
+        replaced with those of the given CallEvent instead, keeping its place in the
+        queue. Returns
+        the queue or Future of the call that will be run. Thread-safe."""
+        try:
+            pending = self.pending[priority]
+        except KeyError:
+            raise ValueError('invalid priority: %r' % (priority,)) from None
+        if self.stats is not None:
+            event._post_time = time.perf_counter()
+        with self.lock:
+            if coalesce_key is not None:
+                existing = self.coalescable.get(coalesce_key)
+                if existing is not None and not existing._returnval.cancelled():
+                    # Replace the function too, since calls to different functions
+                    # may share a key:
+                    existing.fn = event.fn
+                    existing.args = event.args
+                    existing.kwargs = event.kwargs
+                    existing._exceptions_in_main = event._exceptions_in_main
+                    existing.thread_ident = event.thread_ident
+                    return existing._returnval
+                if existing is not None:
+                    # Cancelled. It stays in the queue until it is skipped, but this
+                    # call now takes its place as the one to coalesce with:
+                    existing._coalesce_key = None
+                event._coalesce_key = coalesce_key
+                self.coalescable[coalesce_key] = event
+            pending.append(event)
+            if self.wakeup_priority is not None and self.wakeup_priority >= priority:
+                return event._returnval
+            self.wakeup_priority = priority
+        QCoreApplication.postEvent(self, WakeupEvent(), priority)
+        return event._returnval
+
+    def next_pending(self):
+        """Remove and return the next pending CallEvent, or None if there are none.
+        Must be called with self.lock held."""
+        for priority in PRIORITIES:
+            pending = self.pending[priority]
+            if pending:
+                event = pending.popleft()
+                key = event._coalesce_key
+                if key is not None and self.coalescable.get(key) is event:
+                    # Subsequent calls can no longer be coalesced with this one:
+                    del self.coalescable[key]
+                return event
+        return None
 
     def event(self, event):
-        event.accept()
+        event_type = event.type()
+        if event_type == WakeupEvent.EVENT_TYPE:
+            event.accept()
+            self.drain()
+            return True
+        elif event_type == CallEvent.EVENT_TYPE:
+            event.accept()
+            self.call(event)
+            return True
+        return QObject.event(self, event)
+
+    def drain(self):
+        """Run the calls that were pending when the WakeupEvent was processed, in
+        order of priority and then in the order they were requested, until the time
+        budget, if any, is used up. Calls queued whilst we are doing so are left for a
+        subsequent WakeupEvent, so that a call that queues another call to itself does
+        not prevent the Qt event loop from running.
+
+        Before each call is run, a WakeupEvent is posted if there are further calls
+        pending and one has not already been posted. This way, if the call runs a
+        nested event loop, such as that of a modal dialog, the nested event loop runs
+        the remaining pending calls, as well as any queued in the meantime."""
+        budget = self.budget
+        if budget is not None:
+            deadline = time.perf_counter() + budget
+        with self.lock:
+            # The WakeupEvent that caused this drain has been delivered:
+            self.wakeup_priority = None
+            remaining = sum(len(pending) for pending in self.pending.values())
+        for _ in range(remaining):
+            with self.lock:
+                event = self.next_pending()
+            if event is None:
+                # A nested event loop ran the rest:
+                return
+            self.repost()
+            self.call(event)
+            if budget is not None and time.perf_counter() > deadline:
+                # Yield to the Qt event loop, and continue afterwards:
+                return
+        self.repost()
+
+    def repost(self):
+        """Post a WakeupEvent to run the remaining pending calls, if any, in a
+        subsequent iteration of the Qt event loop, unless one has already been posted
+        with a priority at least as high as that of the remaining calls."""
+        with self.lock:
+            for priority in PRIORITIES:
+                if self.pending[priority]:
+                    break
+            else:
+                return
+            if self.wakeup_priority is not None and self.wakeup_priority >= priority:
+                return
+            self.wakeup_priority = priority
+        QCoreApplication.postEvent(self, WakeupEvent(), priority)
+
+    def call(self, event):
+        """Call the function held within a CallEvent and put the result in its
+        Future or queue."""
+        if isinstance(event._returnval, Future):
+            if not event._returnval.set_running_or_notify_cancel():
+                # Cancelled before it got to run:
+                return
+        stats = self.stats
+        if stats is not None:
+            start_time = time.perf_counter()
         exception = None
+        previous_event = self.current_event
+        self.current_event = event
         try:
             result = event.fn(*event.args, **event.kwargs)
         except Exception:
@@ -54,14 +486,89 @@ class Caller(QObject):
                 # silently:
                 raise
         finally:
+            self.current_event = previous_event
+            if stats is not None:
+                self.record_stats(stats, event, start_time, exception is not None)
             event._returnval.put([result, exception])
-        return True
+
+    def record_stats(self, stats, event, start_time, raised):
+        end_time = time.perf_counter()
+        name = _qualified_name(event.fn)
+        with self.stats_lock:
+            try:
+                call_stats = stats[name]
+            except KeyError:
+                call_stats = stats[name] = CallStats()
+            call_stats.calls += 1
+            exec_time = end_time - start_time
+            call_stats.exec_time_total += exec_time
+            call_stats.exec_time_max = max(call_stats.exec_time_max, exec_time)
+            # Calls posted before stats were enabled, or posted directly with
+            # QCoreApplication.postEvent(), have no post time:
+            post_time = getattr(event, '_post_time', None)
+            if post_time is not None:
+                queue_wait = start_time - post_time
+                call_stats.queue_wait_total += queue_wait
+                call_stats.queue_wait_max = max(call_stats.queue_wait_max, queue_wait)
+            if raised:
+                call_stats.exceptions += 1
 
 
 caller = Caller()
 
 
-def inmain(fn, *args, **kwargs):
+def set_dispatch_budget(budget):
+    """Limit the time spent running queued calls in the main thread in one go.
+
+    Once :code:`budget` seconds have been spent running calls queued by
+    :func:`qtutils.invoke_in_main.inmain` and related functions, any remaining
+    calls are deferred until the Qt event loop has had a chance to process other
+    events, such as paint and input events. This keeps the GUI responsive when a large
+    backlog of calls builds up, at the expense of the backlog taking slightly longer
+    to clear. A budget of around 8ms leaves the remainder of a 60Hz frame for
+    redrawing.
+
+    Arguments:
+        budget: The time budget in seconds, or None for no limit (the default).
+    """
+    if budget is not None and budget < 0:
+        raise ValueError('budget must not be negative')
+    caller.budget = budget
+
+
+def enable_stats(enabled=True):
+    """Enable or disable collecting statistics about calls made in the main thread via
+    :func:`qtutils.invoke_in_main.inmain` and related functions. Disabling does not
+    clear statistics already collected. When disabled, collecting statistics has
+    negligible overhead."""
+    with caller.stats_lock:
+        if not enabled:
+            caller.stats = None
+        elif caller.stats is None:
+            caller.stats = {}
+
+
+def stats():
+    """Return a snapshot of the statistics collected since they were enabled or last
+    reset, as a dict keyed by the qualified name of each function called. Each value is
+    a dict with keys :code:`calls`, :code:`queue_wait_total`, :code:`queue_wait_max`,
+    :code:`exec_time_total`, :code:`exec_time_max` and :code:`exceptions`. Times are in
+    seconds. Queue wait is the time between a call being queued and it starting to run
+    in the main thread. Returns an empty dict if statistics are not enabled."""
+    with caller.stats_lock:
+        if caller.stats is None:
+            return {}
+        return {name: call_stats.as_dict() for name, call_stats in caller.stats.items()}
+
+
+def reset_stats():
+    """Clear all statistics collected so far."""
+    with caller.stats_lock:
+        if caller.stats is not None:
+            caller.stats = {}
+
+
+def inmain(fn, *args, priority=NORMAL_PRIORITY, **kwargs):
     """Execute a function in the main thread. Wait for it to complete
     and return its return value.
     
@@ -79,23 +586,34 @@ def inmain(fn, *args, **kwargs):
         
         **kwargs: Any keyword arguments to pass to :code:`fn` when it is called
                   from the MainThread
+
+    Keyword Arguments:
+        priority: One of :code:`qtutils.invoke_in_main.HIGH_PRIORITY`,
+                  :code:`NORMAL_PRIORITY` (the default) or :code:`LOW_PRIORITY`.
+                  Queued calls of higher priority are run before those of lower
+                  priority. This argument is not passed to :code:`fn`; use
+                  :code:`functools.partial` if :code:`fn` itself takes an argument
+                  named :code:`priority`.
                   
     Returns:
         The result of executing :code:`fn(*args, **kwargs)`
     """
     if threading.current_thread().name == 'MainThread':
         return fn(*args, **kwargs)
-    return get_inmain_result(_in_main_later(fn, False, *args, **kwargs))
+    return get_inmain_result(_post_call(fn, args, kwargs, False, priority))
 
 
-def inmain_later(fn, *args, **kwargs):
+def inmain_later(fn, *args, priority=NORMAL_PRIORITY, coalesce=False, **kwargs):
     """Queue up the executing of a function in the main thread and return immediately.
     
     This function queues up a custom :code:`QEvent` to the Qt event loop.
     This event executes the specified function :code:`fn` in the Python 
     MainThread with the specified arguments and keyword arguments, and returns 
-    a Python Queue which will eventually hold the result from the executing of 
-    :code:`fn`. To access the result, use :func:`qtutils.invoke_in_main.get_inmain_result`.
+    a :class:`qtutils.invoke_in_main.Future` which will eventually hold the result
+    from the executing of :code:`fn`. To access the result, use
+    :func:`qtutils.invoke_in_main.get_inmain_result`, or the Future's
+    :code:`result()` method, which accepts a timeout. If the call has not yet started,
+    it may be cancelled with the Future's :code:`cancel()` method.
     
     This function can be used from the MainThread, but such use will just directly call the function, bypassing the Qt event loop.
     
@@ -107,37 +625,79 @@ def inmain_later(fn, *args, **kwargs):
         
         **kwargs: Any keyword arguments to pass to :code:`fn` when it is called
                   from the MainThread
+
+    Keyword Arguments:
+        priority: The priority of the call, as for
+                  :func:`qtutils.invoke_in_main.inmain`.
+
+        coalesce: If :code:`True`, or a hashable key, then whilst a call with the
+                  same key is still waiting to be run, this call replaces its function
+                  and arguments instead of being queued separately, and the same Future
+                  is returned for both. Only the most recent call is made. If :code:`True`,
+                  the key is :code:`fn` itself, which for a bound method is specific to
+                  the instance. The replaced call keeps its place in the queue and its
+                  priority. Like :code:`priority`, this argument is not passed to
+                  :code:`fn`.
                   
     Returns:
-       A Python Queue which will eventually hold the result 
-       :code:`(fn(*args, **kwargs), exception)` where 
+       A :class:`qtutils.invoke_in_main.Future` which will eventually hold the result
+       of :code:`fn(*args, **kwargs)`. For backward compatibility it may also be used
+       like a Python Queue which will eventually hold the result
+       :code:`(fn(*args, **kwargs), exception)` where
        :code:`exception=[type,value,traceback]`.
     """
-    return _in_main_later(fn, True, *args, **kwargs)
+    if coalesce is True:
+        coalesce_key = fn
+    elif coalesce is False:
+        coalesce_key = None
+    else:
+        coalesce_key = coalesce
+    return _post_call(fn, args, kwargs, True, priority, coalesce_key)
 
 
 def _in_main_later(fn, exceptions_in_main, *args, **kwargs):
     """Asks the mainloop to call a function when it has time. Immediately
-    returns the queue that was sent to the mainloop.  A call to queue.get()
+    returns the Future that was sent to the mainloop.  A call to future.get()
     will return a list of [result,exception] where exception=[type,value,traceback]
     of the exception.  Functions are guaranteed to be called in the order
     they were requested."""
-    queue = Queue()
-    QCoreApplication.postEvent(caller, CallEvent(queue, exceptions_in_main, fn, *args, **kwargs))
-    return queue
+    return _post_call(fn, args, kwargs, exceptions_in_main, NORMAL_PRIORITY)
+
+
+def _post_call(fn, args, kwargs, exceptions_in_main, priority, coalesce_key=None):
+    """Implementation of _in_main_later() taking the arguments for fn as a tuple and
+    dict, so that no argument names are reserved. Functions of the same priority are
+    guaranteed to be called in the order they were requested. If coalesce_key is not
+    None, the Future returned may be that of an earlier, still pending call with the
+    same key, which will now be made with these arguments instead."""
+    # Set the arguments after construction rather than passing them to CallEvent(), so
+    # that fn may take arguments named like those of CallEvent.__init__():
+    event = CallEvent(Future(), exceptions_in_main, fn)
+    event.args = args
+    event.kwargs = kwargs
+    return caller.post(event, priority, coalesce_key)
+
+
+def _is_method(fn):
+    """Whether a function appears to have been defined in a class body, based on its
+    qualified name. False for callables without one, such as functools.partial
+    objects."""
+    path = getattr(fn, '__qualname__', '').split('.')
+    return len(path) > 1 and path[-2] != '<locals>'
 
 
 def get_inmain_result(queue):
     """ Processes the result of :func:`qtutils.invoke_in_main.inmain_later`.
     
-    This function takes the queue returned by :code:`inmain_later` and blocks
-    until a result is obtained. If an exception occurred when executing the
+    This function takes the Future (or queue) returned by :code:`inmain_later` and
+    blocks until a result is obtained. If an exception occurred when executing the
     function in the MainThread, it is raised again here (it is also raised in the
     MainThread). If no exception was raised, the result from the execution of the
     function is returned.
     
     Arguments:
-        queue: The Python Queue object returned by :code:`inmain_later`
+        queue: The :class:`qtutils.invoke_in_main.Future` object returned by
+               :code:`inmain_later`
         
     Returns:
         The result from executing the function specified in the call to 
@@ -151,6 +711,190 @@ def get_inmain_result(queue):
     return result
 
 
+async def inmain_async(fn, *args, priority=NORMAL_PRIORITY, **kwargs):
+    """Execute a function in the main thread, awaitably.
+
+    This is the asyncio counterpart of :func:`qtutils.invoke_in_main.inmain`. The
+    call is queued to the Qt event loop in the same way, but rather than blocking the
+    calling thread, the coroutine is suspended until the result is available, leaving
+    the calling thread's asyncio event loop free to run other tasks. The result is
+    passed back to the calling thread's event loop with
+    :code:`loop.call_soon_threadsafe()`. If the awaiting task is cancelled before the
+    call has started running in the MainThread, the call is cancelled too.
+
+    If awaited from the MainThread, the function is called directly.
+
+    Arguments:
+        fn: A reference to the function or method to run in the MainThread.
+
+        *args: Any arguments to pass to :code:`fn` when it is called from the
+               MainThread.
+
+        **kwargs: Any keyword arguments to pass to :code:`fn` when it is called
+                  from the MainThread
+
+    Keyword Arguments:
+        priority: The priority of the call, as for
+                  :func:`qtutils.invoke_in_main.inmain`.
+
+    Returns:
+        The result of executing :code:`fn(*args, **kwargs)`
+    """
+    if threading.current_thread().name == 'MainThread':
+        return fn(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    asyncio_future = loop.create_future()
+
+    def on_done(future):
+        loop.call_soon_threadsafe(_copy_future_state, future, asyncio_future)
+
+    future = _post_call(fn, args, kwargs, False, priority)
+    future.add_done_callback(on_done)
+    try:
+        return await asyncio_future
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+
+
+def _copy_future_state(source, destination):
+    """Copy the result or exception of a done Future to an asyncio, concurrent.futures
+    or qtutils.invoke_in_main Future, unless the latter has been cancelled."""
+    if destination.cancelled():
+        return
+    if source.cancelled():
+        if not destination.cancel():
+            # Already running, so can no longer be marked cancelled:
+            destination.set_exception(concurrent.futures.CancelledError())
+        return
+    exception = source.exception()
+    if exception is not None:
+        destination.set_exception(exception)
+    else:
+        destination.set_result(source.result())
+
+
+class _MainAsyncioLoop(object):
+    """An asyncio event loop in the main thread, iterated by the Qt event loop whilst
+    there are coroutines running in it. After each iteration, a single-shot QTimer is
+    set for when the asyncio event loop next has a callback due, and QSocketNotifiers
+    watch the file descriptors its selector is waiting on. These include the one
+    written to by loop.call_soon_threadsafe(), so that other threads can wake it. Event
+    loops without a selector are instead iterated every ASYNCIO_POLL_INTERVAL
+    seconds."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.tasks = set()
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.step)
+        # QSocketNotifiers by (file descriptor, QSocketNotifier.Type):
+        self.notifiers = {}
+
+    def start(self, coro, future):
+        if not future.set_running_or_notify_cancel():
+            coro.close()
+            return
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(lambda task: self.on_task_done(task, future))
+        # Start the coroutine running right away:
+        self.step()
+
+    def step(self, *args):
+        """Run a single iteration of the asyncio event loop, and arrange for the next
+        one."""
+        if self.loop.is_running():
+            # Re-entered via a nested Qt event loop. Let the outer iteration finish,
+            # and stop the notifiers firing repeatedly in the meantime:
+            for notifier in self.notifiers.values():
+                notifier.setEnabled(False)
+            return
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+        self.schedule()
+
+    def schedule(self):
+        """Set the timer and notifiers to call step() once the asyncio event loop has
+        something to do, or stop them if no coroutines are running."""
+        if not self.tasks:
+            self.timer.stop()
+            self.watch({})
+            return
+        selector = getattr(self.loop, '_selector', None)
+        if selector is None:
+            self.timer.start(int(round(1000 * ASYNCIO_POLL_INTERVAL)))
+            return
+        self.watch(selector.get_map())
+        if self.loop._ready:
+            self.timer.start(0)
+        elif self.loop._scheduled:
+            timeout = self.loop._scheduled[0].when() - self.loop.time()
+            # Clipped to a day, to stay within the range of QTimer's interval:
+            self.timer.start(max(0, min(int(math.ceil(1000 * timeout)), 86400000)))
+        else:
+            # Nothing to do until a file descriptor is ready:
+            self.timer.stop()
+
+    def watch(self, fd_map):
+        """Have the QSocketNotifiers watch the file descriptors in the given mapping of
+        a selector, and no others."""
+        wanted = set()
+        for key in fd_map.values():
+            if key.events & selectors.EVENT_READ:
+                wanted.add((key.fd, QSocketNotifier.Type.Read))
+            if key.events & selectors.EVENT_WRITE:
+                wanted.add((key.fd, QSocketNotifier.Type.Write))
+        for fd_type in list(self.notifiers):
+            if fd_type not in wanted:
+                notifier = self.notifiers.pop(fd_type)
+                notifier.setEnabled(False)
+                notifier.deleteLater()
+        for fd, notifier_type in wanted:
+            notifier = self.notifiers.get((fd, notifier_type))
+            if notifier is None:
+                notifier = QSocketNotifier(fd, notifier_type)
+                notifier.activated.connect(self.step)
+                self.notifiers[fd, notifier_type] = notifier
+            notifier.setEnabled(True)
+
+    def on_task_done(self, task, future):
+        self.tasks.discard(task)
+        _copy_future_state(task, future)
+
+
+_main_asyncio_loop = None
+
+
+def _start_coroutine_in_main(coro, future):
+    global _main_asyncio_loop
+    if _main_asyncio_loop is None:
+        _main_asyncio_loop = _MainAsyncioLoop()
+    _main_asyncio_loop.start(coro, future)
+
+
+def run_coroutine_in_main(coro):
+    """Run a coroutine in an asyncio event loop in the main thread.
+
+    The event loop is created on first use and is iterated by the Qt event loop
+    whenever it has callbacks due or file descriptors ready, whilst any coroutines are
+    running in it. Coroutines run this way may therefore use Qt objects directly, and
+    interleave with Qt event processing whenever they await. This function may be
+    called from any thread.
+
+    Arguments:
+        coro: The coroutine object to run.
+
+    Returns:
+        A :class:`qtutils.invoke_in_main.Future` which will eventually hold the
+        result of the coroutine.
+    """
+    future = Future()
+    _in_main_later(_start_coroutine_in_main, True, coro, future)
+    return future
+
+
 def inthread(f, *args, **kwargs):
     """A convenience function for starting a Python thread.
     
@@ -175,7 +919,202 @@ def inthread(f, *args, **kwargs):
     return thread
 
 
-def inmain_decorator(wait_for_return=True, exceptions_in_main=True):
+class _JobFuture(Future):
+    """A Future for a job run by a ThreadPool, which logs the job's exception, if any,
+    if it is garbage collected without the exception having been retrieved. Otherwise
+    exceptions in jobs whose results nobody looks at would pass silently."""
+
+    __slots__ = ('_unretrieved',)
+
+    def __init__(self):
+        Future.__init__(self)
+        self._unretrieved = False
+
+    def set_exception(self, exception):
+        self._unretrieved = True
+        Future.set_exception(self, exception)
+
+    def result(self, timeout=None):
+        self._unretrieved = False
+        return Future.result(self, timeout)
+
+    def exception(self, timeout=None):
+        self._unretrieved = False
+        return Future.exception(self, timeout)
+
+    def get(self, block=True, timeout=None):
+        self._unretrieved = False
+        return Future.get(self, block, timeout)
+
+    def __del__(self):
+        if self._unretrieved:
+            logger.error(
+                'Exception in thread pool job was never retrieved',
+                exc_info=self._exc_info,
+            )
+
+
+class ThreadPool(object):
+    """A pool of daemon threads for running short jobs in the background, without the
+    cost of starting a new thread for each one.
+
+    Worker threads are started as needed, up to :code:`max_workers`, and then kept
+    for running subsequent jobs. Jobs submitted whilst all workers are busy wait in a
+    queue. If :code:`max_queued` is nonzero, at most that many jobs may wait, and
+    further calls to :code:`submit()` block until there is room.
+
+    Arguments:
+        max_workers: The maximum number of worker threads. Defaults to the number of
+                     CPUs plus four, but no more than 32.
+
+        max_queued: The maximum number of jobs waiting for a worker, or zero for no
+                    limit.
+    """
+
+    def __init__(self, max_workers=None, max_queued=0):
+        if max_workers is None:
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+        if max_workers <= 0:
+            raise ValueError('max_workers must be greater than zero')
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.queue = queue.Queue(max_queued)
+        self.lock = threading.Lock()
+        self.threads = []
+        self.busy = 0
+        # The number of workers waiting for a job that no submitted job is yet
+        # counting on:
+        self.idle = 0
+        self.submitted = 0
+        self.completed = 0
+        self.shutting_down = False
+
+    def submit(self, f, *args, **kwargs):
+        """Run :code:`f(*args, **kwargs)` in a worker thread. Returns a
+        :class:`qtutils.invoke_in_main.Future` for its result. Use the Future's
+        :code:`add_done_callback(fn, in_main=True)` to have a callback run in the main
+        thread when the job is done. If the job raises an exception, and it is not
+        retrieved from the Future before the Future is garbage collected, it is logged
+        to the :code:`qtutils.invoke_in_main` logger."""
+        if self.shutting_down:
+            raise RuntimeError('cannot submit jobs after shutdown')
+        future = _JobFuture()
+        self.queue.put((future, f, args, kwargs))
+        with self.lock:
+            self.submitted += 1
+            if self.idle:
+                # An idle worker will run the job:
+                self.idle -= 1
+            elif len(self.threads) < self.max_workers:
+                thread = threading.Thread(
+                    target=self.worker, name='ThreadPool-%d' % len(self.threads)
+                )
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        return future
+
+    def worker(self):
+        # A worker is started for a job that has been submitted, and so is not idle
+        # until it has taken a job from the queue and finished with it:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            future, f, args, kwargs = item
+            # Drop our reference to the job before blocking on the queue again:
+            del item
+            if future.set_running_or_notify_cancel():
+                with self.lock:
+                    self.busy += 1
+                try:
+                    result = f(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+                finally:
+                    with self.lock:
+                        self.busy -= 1
+                        self.completed += 1
+            del future, f, args, kwargs
+            with self.lock:
+                self.idle += 1
+
+    def stats(self):
+        """Return a dict with the number of worker threads, the number of them busy
+        running a job, the fraction of :code:`max_workers` busy, the number of jobs
+        waiting for a worker, and the total numbers of jobs submitted and completed."""
+        with self.lock:
+            return {
+                'workers': len(self.threads),
+                'busy': self.busy,
+                'utilisation': self.busy / self.max_workers,
+                'queued': self.queue.qsize(),
+                'submitted': self.submitted,
+                'completed': self.completed,
+            }
+
+    def shutdown(self, wait=True):
+        """Stop the worker threads once all queued jobs have been run. If
+        :code:`wait=True`, block until they have stopped."""
+        self.shutting_down = True
+        with self.lock:
+            threads = list(self.threads)
+        for _ in threads:
+            self.queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+_default_thread_pool = None
+_default_thread_pool_lock = threading.Lock()
+
+
+def default_thread_pool():
+    """Return the :class:`qtutils.invoke_in_main.ThreadPool` used by
+    :func:`qtutils.invoke_in_main.inthread_pool`, creating it with default arguments if
+    it does not yet exist."""
+    global _default_thread_pool
+    with _default_thread_pool_lock:
+        if _default_thread_pool is None:
+            _default_thread_pool = ThreadPool()
+        return _default_thread_pool
+
+
+def inthread_pool(f, *args, **kwargs):
+    """Run a function in a thread from a pool of reusable daemon threads.
+
+    This is a pooled alternative to :func:`qtutils.invoke_in_main.inthread`, which
+    avoids the cost of starting a new thread for each call, and limits the number of
+    threads. It uses the pool returned by
+    :func:`qtutils.invoke_in_main.default_thread_pool`. To configure the number of
+    worker threads or the size of the queue of waiting jobs, create a
+    :class:`qtutils.invoke_in_main.ThreadPool` and call its :code:`submit()` method
+    instead.
+
+    Whereas an exception raised in a thread started with :code:`inthread` is reported
+    by :code:`threading.excepthook`, an exception raised by :code:`f` is stored in the
+    returned Future. If it is never retrieved from the Future, it is logged when the
+    Future is garbage collected.
+
+    Arguments:
+        f: A reference to the target function to be executed in a worker thread.
+
+        *args: Any arguments to pass to :code:`f`.
+
+        **kwargs: Any keyword arguments to pass to :code:`f`.
+
+    Returns:
+        A :class:`qtutils.invoke_in_main.Future` which will eventually hold the
+        result of :code:`f(*args, **kwargs)`
+    """
+    return default_thread_pool().submit(f, *args, **kwargs)
+
+
+def inmain_decorator(wait_for_return=True, exceptions_in_main=True, priority=NORMAL_PRIORITY,
+                     coalesce=False, coalesce_key=None):
     """ A decorator which enforces the execution of the decorated thread to occur in the MainThread.
     
     This decorator wraps the decorated function or method in either 
@@ -193,6 +1132,22 @@ def inmain_decorator(wait_for_return=True, exceptions_in_main=True):
                             :code:`False`, then exceptions may be silenced if
                             you do not explicitly use
                             :func:`qtutils.invoke_in_main.get_inmain_result`.
+
+        priority: The priority of calls to the decorated function, as for
+                  :func:`qtutils.invoke_in_main.inmain`.
+
+        coalesce: If :code:`True`, then whilst a call to the decorated function is
+                  waiting to be run in the MainThread, further calls replace its
+                  arguments instead of being queued separately. Only the most recent
+                  call is made, and all callers receive its result. This is useful for
+                  functions such as status or progress updates that may be called
+                  faster than the screen refreshes, and for which only the most recent
+                  call matters. By default, calls to a method are only coalesced with
+                  calls to the same method of the same instance.
+
+        coalesce_key: A function, called with the same arguments as the decorated
+                      function, returning a hashable key. Only calls with equal keys
+                      are coalesced. Ignored unless :code:`coalesce=True`.
                             
     Returns:
         The decorator returns a function that has wrapped the decorated function
@@ -202,17 +1157,33 @@ def inmain_decorator(wait_for_return=True, exceptions_in_main=True):
         
         When calling the decorated function, the result is either the result of 
         the function executed in the MainThread (if :code:`wait_for_return=True`)
-        or a Python Queue to be used with 
+        or a :class:`qtutils.invoke_in_main.Future` to be used with 
         :func:`qtutils.invoke_in_main.get_inmain_result` at a later time.
         
     """
     def wrap(fn):
         """A decorator which sets any function to always run in the main thread."""
+        is_method = coalesce and _is_method(fn)
+
+        def get_key(args, kwargs):
+            if not coalesce:
+                return None
+            if coalesce_key is not None:
+                return (fn, coalesce_key(*args, **kwargs))
+            if is_method and args:
+                # The instance is kept alive by the pending call for as long as the key
+                # is in use, so its id cannot be reused in the meantime:
+                return (fn, id(args[0]))
+            return fn
+
         @functools.wraps(fn)
         def f(*args, **kwargs):
             if wait_for_return:
-                return inmain(fn, *args, **kwargs)
-            return _in_main_later(fn, exceptions_in_main, *args, **kwargs)
+                if threading.current_thread().name == 'MainThread':
+                    return fn(*args, **kwargs)
+                future = _post_call(fn, args, kwargs, False, priority, get_key(args, kwargs))
+                return get_inmain_result(future)
+            return _post_call(fn, args, kwargs, exceptions_in_main, priority, get_key(args, kwargs))
         return f
     return wrap
 
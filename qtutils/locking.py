@@ -12,10 +12,98 @@
 #                                                                   #
 #####################################################################
 
+import os
+import sys
+import time
+import types
 import threading
+import weakref
 
 from qtutils.qt.QtCore import QEvent, QObject, QCoreApplication
 
+# Ways of enforcing that qtlock is held for Qt calls from non-main threads. See
+# QtLock.enforce():
+ENFORCE_MODES = ('off', 'profile', 'monitoring')
+
+
+def default_enforce_mode():
+    """The enforcement mode used when qtutils is imported. This is the value of the
+    QTUTILS_QTLOCK_ENFORCE environment variable if set. Otherwise it is 'off' if Python
+    is running with optimisations enabled (python -O), 'monitoring' on Python 3.12+, and
+    'profile' on earlier versions."""
+    mode = os.getenv('QTUTILS_QTLOCK_ENFORCE')
+    if mode is not None:
+        if mode not in ENFORCE_MODES:
+            msg = f"QTUTILS_QTLOCK_ENFORCE={mode} must be one of {','.join(ENFORCE_MODES)}"
+            raise EnvironmentError(msg)
+        return mode
+    if not __debug__:
+        return 'off'
+    if hasattr(sys, 'monitoring'):
+        return 'monitoring'
+    return 'profile'
+
+
+# Upper bounds, in seconds, of the bins of the histograms of times spent waiting for and
+# holding qtlock. The last bin, for times longer than all of these, is unbounded:
+HISTOGRAM_BINS = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+
+
+class LockStats(object):
+    """Statistics on acquiring and holding qtlock, either for one thread or for all
+    threads. Only acquisitions by non-main threads that had to block the mainloop
+    are counted; re-entrant acquisitions are not. thread_name is the name of the
+    thread the statistics are for, or None if they are for all threads."""
+
+    def __init__(self, thread_name=None):
+        self.thread_name = thread_name
+        self.acquisitions = 0
+        self.timeouts = 0
+        self.wait_time_total = 0.0
+        self.hold_time_total = 0.0
+        self.wait_histogram = [0] * (len(HISTOGRAM_BINS) + 1)
+        self.hold_histogram = [0] * (len(HISTOGRAM_BINS) + 1)
+        self.longest_hold = 0.0
+        self.longest_hold_call_site = None
+
+    @staticmethod
+    def bin_index(duration):
+        for i, upper_bound in enumerate(HISTOGRAM_BINS):
+            if duration <= upper_bound:
+                return i
+        return len(HISTOGRAM_BINS)
+
+    def record_wait(self, wait_time, acquired):
+        if acquired:
+            self.acquisitions += 1
+        else:
+            self.timeouts += 1
+        self.wait_time_total += wait_time
+        self.wait_histogram[self.bin_index(wait_time)] += 1
+
+    def record_hold(self, hold_time, call_site):
+        self.hold_time_total += hold_time
+        self.hold_histogram[self.bin_index(hold_time)] += 1
+        if hold_time > self.longest_hold:
+            self.longest_hold = hold_time
+            self.longest_hold_call_site = call_site
+
+    def as_dict(self):
+        """Return the statistics as a dict. Times are in seconds. The histograms are
+        lists of counts, with bins bounded by HISTOGRAM_BINS. longest_hold_call_site
+        is a (filename, lineno, function name) tuple for where the lock was acquired
+        for its longest hold, or None."""
+        return {
+            'acquisitions': self.acquisitions,
+            'timeouts': self.timeouts,
+            'wait_time_total': self.wait_time_total,
+            'hold_time_total': self.hold_time_total,
+            'wait_histogram': list(self.wait_histogram),
+            'hold_histogram': list(self.hold_histogram),
+            'longest_hold': self.longest_hold,
+            'longest_hold_call_site': self.longest_hold_call_site,
+        }
+
 
 class BlockEvent(QEvent):
     """An event requesting the mainloop to be blocked until further notice."""
@@ -25,15 +113,34 @@ class BlockEvent(QEvent):
         QEvent.__init__(self, self.EVENT_TYPE)
         self.blocked = blocked
         self.unblock = unblock
+        # The thread that requested the block, for diagnostics:
+        self.thread_ident = threading.get_ident()
+        # Set, with self.lock held, by a thread that gave up waiting for the
+        # block before the mainloop got to it:
+        self.lock = threading.Lock()
+        self.cancelled = False
 
 
 class Blocker(QObject):
-    """An event handler which blocks until event.unblock is set."""
+    """An event handler which blocks until event.unblock is set, unless the
+    event has been cancelled."""
+
+    def __init__(self):
+        QObject.__init__(self)
+        # The BlockEvent currently blocking the mainloop, for diagnostics:
+        self.current_event = None
 
     def event(self, event):
-        event.blocked.set()
-        event.unblock.wait()
-        event.unblock.clear()
+        with event.lock:
+            if event.cancelled:
+                return True
+            event.blocked.set()
+        self.current_event = event
+        try:
+            event.unblock.wait()
+            event.unblock.clear()
+        finally:
+            self.current_event = None
         return True
 
 
@@ -47,12 +154,49 @@ class QtLock():
     the main loop can be blocked, and exiting the context manager will
     unblock the mainloop. If we are already in the main thread, the
     context manager does nothing. Regardless of thread, it can be used
-    re-entrantly and is completely thread-safe."""
+    re-entrantly and is completely thread-safe.
 
-    def __init__(self):
+    By default, each thread entering the context manager blocks the
+    mainloop separately, so N threads wanting the lock at about the same
+    time block the mainloop N times in turn, letting it run briefly in
+    between. If shared=True, threads wanting the lock whilst the mainloop is
+    already blocked for another thread instead join that same block, and
+    the mainloop is only unblocked once the last of them has exited the
+    context manager. The threads still hold the lock one at a time, so this
+    does not change what code can safely do whilst holding it; it just
+    reduces the number of times the mainloop is stalled. The cost is that
+    the mainloop may remain blocked for as long as there are threads
+    waiting for the lock. The shared attribute can be changed at any time,
+    and affects subsequent acquisitions only."""
+
+    def __init__(self, shared=False):
         # Thread local storage, to make our methods thread-safe without
         # locking:
         self.local = threading.local()
+        self.shared = shared
+        # State of the block of the mainloop shared between threads when
+        # self.shared is True:
+        self.shared_state_lock = threading.Lock()
+        self.shared_participants = 0
+        self.shared_blocked = threading.Event()
+        self.shared_unblock = threading.Event()
+        # Held by whichever thread currently holds the lock via the shared block:
+        self.shared_mutex = threading.Lock()
+        # The BlockEvent of the current or most recent shared block:
+        self.shared_event = None
+        # Statistics on acquiring and holding the lock:
+        self.stats_lock = threading.Lock()
+        self.global_stats = LockStats()
+        # Per-thread statistics by thread ident. Each thread holds a reference to
+        # its own LockStats in thread local storage, so that its entry goes away
+        # when the thread exits:
+        self.stats_by_thread = weakref.WeakValueDictionary()
+        # Incremented by reset_stats(), so that threads know to start afresh:
+        self.stats_generation = 0
+        # The sys.monitoring tool id in use, if enforcing in 'monitoring' mode:
+        self.monitoring_tool_id = None
+        # Whether 'monitoring' mode has been used before in this process:
+        self.monitoring_used = False
 
     def per_thread_init(self):
         """Due to thread local storage, we couldn't initialise in __init__
@@ -73,36 +217,273 @@ class QtLock():
             self.per_thread_init()
         return self.local.held
 
-    def enforce(self, enable=True):
+    def check(self, obj):
+        """Raise an exception if obj is a QObject and we are not in the main
+        thread and do not hold the lock."""
+        if isinstance(obj, QObject) and not self.held():
+            message = 'qtlock was not acquired for this Qt call, and we are not in the main thread.'
+            raise threading.ThreadError(message)
+
+    def enforce(self, enable=True, mode='profile'):
         """Raises an exception when Qt method calls are made from a
-        non-main thread without the mainloop blocked. Only takes effect
-        on threads created after enforce() is called."""
-        def enforce(frame, event, func):
-            if event == 'c_call':
-                if isinstance(func.__self__, QObject):
-                    if not self.held():
-                        message = 'qtlock was not acquired for this Qt call, and we are not in the main thread.'
-                        raise threading.ThreadError(message)
-        threading.setprofile(enforce if enable else None)
+        non-main thread without the mainloop blocked. The mode determines
+        how, and at what cost, calls are checked:
+
+        'profile': Every call to a method of a QObject is checked, using a
+        profile function installed with threading.setprofile(). Only takes
+        effect on threads created after enforce() is called. The profile
+        function is called for every function call in those threads, which
+        slows them down considerably.
+
+        'monitoring': Only available on Python 3.12+. Uses sys.monitoring,
+        and takes effect on all threads. Monitoring of each call site is
+        disabled as soon as it is seen calling something other than a Qt
+        method, so there is close to no overhead once code has warmed up.
+        The trade-off is that a call site that calls something else the first
+        time it runs, and a Qt method later, is not checked.
+
+        'off': Equivalent to enable=False."""
+        if mode not in ENFORCE_MODES:
+            raise ValueError(f"mode must be one of {','.join(ENFORCE_MODES)}")
+        threading.setprofile(None)
+        self._stop_monitoring()
+        if not enable or mode == 'off':
+            return
+        if mode == 'profile':
+            def enforce(frame, event, func):
+                if event == 'c_call':
+                    self.check(func.__self__)
+            threading.setprofile(enforce)
+        elif mode == 'monitoring':
+            self._start_monitoring()
+
+    def _start_monitoring(self):
+        if not hasattr(sys, 'monitoring'):
+            raise RuntimeError("'monitoring' mode requires Python 3.12 or later")
+        monitoring = sys.monitoring
+        # Tool ids 3 and 4 are not reserved for any particular kind of tool:
+        for tool_id in (3, 4):
+            if monitoring.get_tool(tool_id) is None:
+                break
+        else:
+            raise RuntimeError('No free sys.monitoring tool id')
+        monitoring.use_tool_id(tool_id, 'qtutils.locking')
+
+        def on_call(code, instruction_offset, func, arg0):
+            if type(func) is not types.BuiltinFunctionType:
+                return monitoring.DISABLE
+            # As in 'profile' mode, only bound methods are checked. Unbound
+            # methods cannot be told apart from static methods such as
+            # QCoreApplication.postEvent():
+            if not isinstance(func.__self__, QObject):
+                return monitoring.DISABLE
+            self.check(func.__self__)
+
+        monitoring.register_callback(tool_id, monitoring.events.CALL, on_call)
+        monitoring.set_events(tool_id, monitoring.events.CALL)
+        if self.monitoring_used:
+            # Re-enable any call sites disabled by a previous use of this mode. This
+            # also re-enables those disabled by other tools, such as coverage tools
+            # and debuggers, so is not done the first time:
+            monitoring.restart_events()
+        self.monitoring_used = True
+        self.monitoring_tool_id = tool_id
+
+    def _stop_monitoring(self):
+        if self.monitoring_tool_id is None:
+            return
+        monitoring = sys.monitoring
+        monitoring.set_events(self.monitoring_tool_id, monitoring.events.NO_EVENTS)
+        monitoring.register_callback(self.monitoring_tool_id, monitoring.events.CALL, None)
+        monitoring.free_tool_id(self.monitoring_tool_id)
+        self.monitoring_tool_id = None
+
+    def acquire(self, blocking=True, timeout=None):
+        """Acquire the lock, blocking the mainloop. Returns True if the lock
+        was acquired. Waits at most timeout seconds (or forever if timeout is
+        None) before giving up and returning False.
+
+        If blocking is False, or timeout is zero, the lock is only acquired if
+        that can be done without waiting, which is the case if this thread
+        already holds it, or in shared mode if the mainloop is already
+        blocked and no other thread holds the lock. Since blocking the
+        mainloop always means waiting for it, in the default non-shared mode
+        this never succeeds unless the lock is already held. A failed attempt
+        does not post a request to block the mainloop, and is not counted in
+        the statistics."""
+        if not blocking:
+            timeout = 0
+        return self._acquire(timeout, sys._getframe(1))
+
+    def release(self):
+        """Release the lock, unblocking the mainloop if this thread has
+        released it as many times as it acquired it."""
+        if not self.held():
+            raise RuntimeError('release unlocked lock')
+        # Only unblock the mainloop if we've popped out of the outer-most
+        # context:
+        self.local.held -= 1
+        if not self.local.held:
+            hold_time = time.perf_counter() - self.local.acquired_time
+            if self.local.shared:
+                self.leave_shared_block()
+            else:
+                self.local.unblock.set()
+            self.record_hold(hold_time, self.local.call_site)
 
     def __enter__(self):
+        self._acquire(None, sys._getframe(1))
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def _acquire(self, timeout, frame):
         # Only block the mainloop if it is not already blocked:
         if not self.held():
-            # Ask the mainloop to please process a BlockEvent when it gets the chance:
-            event = BlockEvent(self.local.blocked, self.local.unblock)
-            QCoreApplication.postEvent(blocker, event)
-            # Wait until the mainloop is blocked:
-            self.local.blocked.wait()
-            self.local.blocked.clear()
+            start_time = time.perf_counter()
+            # Remember which kind of block this is, in case self.shared
+            # changes before we exit:
+            self.local.shared = self.shared
+            if timeout == 0:
+                # Don't request a block of the mainloop only to cancel it:
+                if not (self.local.shared and self.try_join_shared_block()):
+                    return False
+                acquired = True
+            elif self.local.shared:
+                acquired = self.join_shared_block(timeout)
+            else:
+                acquired = self.block(timeout)
+            self.local.acquired_time = time.perf_counter()
+            self.record_wait(self.local.acquired_time - start_time, acquired)
+            if not acquired:
+                return False
+            code = frame.f_code
+            self.local.call_site = (code.co_filename, frame.f_lineno, code.co_name)
         # Keep track of the re-entrance depth:
         self.local.held += 1
+        return True
 
-    def __exit__(self, *exc_info):
-        # Only unblock the mainloop if we've popped out of the outer-most
-        # context:
-        self.local.held -= 1
-        if not self.local.held:
-            self.local.unblock.set()
+    def block(self, timeout):
+        """Block the mainloop for this thread alone, waiting at most timeout
+        seconds, or forever if timeout is None. Returns whether the mainloop
+        was blocked."""
+        # Ask the mainloop to please process a BlockEvent when it gets the chance:
+        event = BlockEvent(self.local.blocked, self.local.unblock)
+        QCoreApplication.postEvent(blocker, event)
+        # Wait until the mainloop is blocked:
+        if not self.local.blocked.wait(timeout):
+            with event.lock:
+                if not self.local.blocked.is_set():
+                    # Tell the mainloop not to block after all:
+                    event.cancelled = True
+                    return False
+        self.local.blocked.clear()
+        return True
+
+    def join_shared_block(self, timeout):
+        """Block the mainloop, or join an existing block of it, and wait for
+        our turn to hold the lock, waiting at most timeout seconds, or
+        forever if timeout is None. Returns whether the lock was acquired."""
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        with self.shared_state_lock:
+            self.shared_participants += 1
+            if self.shared_participants == 1:
+                self.shared_event = BlockEvent(self.shared_blocked, self.shared_unblock)
+                QCoreApplication.postEvent(blocker, self.shared_event)
+        if not self.shared_blocked.wait(timeout):
+            self.leave_shared_block(release_mutex=False)
+            return False
+        if timeout is None:
+            self.shared_mutex.acquire()
+        elif not self.shared_mutex.acquire(True, max(0, deadline - time.monotonic())):
+            self.leave_shared_block(release_mutex=False)
+            return False
+        return True
+
+    def try_join_shared_block(self):
+        """Acquire the lock without waiting, if the mainloop is already blocked
+        in shared mode and no other thread holds the lock. Returns whether the
+        lock was acquired."""
+        with self.shared_state_lock:
+            if not self.shared_blocked.is_set():
+                return False
+            if not self.shared_mutex.acquire(False):
+                return False
+            self.shared_participants += 1
+        return True
+
+    def leave_shared_block(self, release_mutex=True):
+        """Release the lock, and unblock the mainloop if no other threads are
+        waiting for it."""
+        if release_mutex:
+            self.shared_mutex.release()
+        with self.shared_state_lock:
+            self.shared_participants -= 1
+            if not self.shared_participants:
+                with self.shared_event.lock:
+                    if self.shared_blocked.is_set():
+                        self.shared_blocked.clear()
+                        self.shared_unblock.set()
+                    else:
+                        # Everyone gave up before the mainloop was blocked.
+                        # Tell it not to block after all:
+                        self.shared_event.cancelled = True
+
+    def thread_stats(self):
+        """The LockStats for the current thread, creating them if need be"""
+        if getattr(self.local, 'stats_generation', None) != self.stats_generation:
+            with self.stats_lock:
+                thread_stats = LockStats(threading.current_thread().name)
+                self.stats_by_thread[threading.get_ident()] = thread_stats
+                self.local.stats = thread_stats
+                self.local.stats_generation = self.stats_generation
+        return self.local.stats
+
+    def record_wait(self, wait_time, acquired):
+        thread_stats = self.thread_stats()
+        with self.stats_lock:
+            for lock_stats in (self.global_stats, thread_stats):
+                lock_stats.record_wait(wait_time, acquired)
+
+    def record_hold(self, hold_time, call_site):
+        thread_stats = self.thread_stats()
+        with self.stats_lock:
+            for lock_stats in (self.global_stats, thread_stats):
+                lock_stats.record_hold(hold_time, call_site)
+
+    def stats(self):
+        """Return a dict with statistics for all threads combined under the
+        key 'global', and under the key 'threads', for each thread that has
+        used the lock and is still running, by thread ident. See
+        LockStats.as_dict() for the statistics for each. The per-thread dicts
+        additionally contain the thread's name under the key 'name'. Threads
+        that have exited only contribute to the global statistics."""
+        with self.stats_lock:
+            return {
+                'global': self.global_stats.as_dict(),
+                'threads': {
+                    ident: dict(lock_stats.as_dict(), name=lock_stats.thread_name)
+                    for ident, lock_stats in list(self.stats_by_thread.items())
+                },
+            }
+
+    def reset_stats(self):
+        """Clear all statistics collected so far."""
+        with self.stats_lock:
+            self.global_stats = LockStats()
+            self.stats_by_thread.clear()
+            self.stats_generation += 1
 
 
 qtlock = QtLock()
+
+
+def stats():
+    """Return statistics on acquisitions of qtlock, see QtLock.stats()."""
+    return qtlock.stats()
+
+
+def reset_stats():
+    """Clear the statistics on acquisitions of qtlock collected so far."""
+    qtlock.reset_stats()
@@ -12,10 +12,20 @@
 #                                                                   #
 #####################################################################
 
+import os
 import sys
+import time
+import codecs
 import queue
+import struct
+import logging
+import weakref
+import tempfile
+import functools
+import collections
 
 import threading
+import itertools
 
 from qtutils.qt.QtCore import *
 from qtutils.qt.QtGui import *
@@ -58,14 +68,74 @@ FORMAT_ALIASES =  {
     'CRITICAL': (RED, True, True)
 }
 
-_charformats = {}
+# Max number of QTextCharFormats to cache:
+CHARFORMAT_CACHE_SIZE = 256
 
+# Max number of charformats to assign compact ids to. Further charformats are sent as
+# their reprs:
+MAX_CHARFORMAT_IDS = 1024
 
-def charformats(charformat_repr):
+# Registry of charformats with compact ids, for sending between threads of this
+# process. Writers send the id as a charformat frame of a zero byte followed by the id
+# as a little-endian unsigned int, rather than the charformat's repr. Since ids never
+# change once assigned, a message in flight can always be decoded. Other processes
+# don't share the registry, and so still send reprs:
+_charformat_ids_lock = threading.Lock()
+_charformat_reprs = []
+_charformat_frames = {}
+_CHARFORMAT_ID = struct.Struct('<I')
+
+# For unique inproc endpoint names for each OutputBox:
+_inproc_ids = itertools.count()
+
+
+def charformat_frame(charformat):
+    """Return the frame to send to an OutputBox in this process for the given
+    charformat, which may be an alias from FORMAT_ALIASES, or a (color, bold, italic)
+    tuple, or the repr of one"""
     try:
-        return _charformats[charformat_repr]
+        return _charformat_frames[charformat]
+    except TypeError:
+        # Unhashable:
+        return _repr_frame(charformat)
     except KeyError:
         pass
+    with _charformat_ids_lock:
+        if charformat in _charformat_frames:
+            return _charformat_frames[charformat]
+        if len(_charformat_reprs) >= MAX_CHARFORMAT_IDS:
+            return _repr_frame(charformat)
+        _charformat_reprs.append(_repr_frame(charformat).decode('utf8'))
+        frame = b'\x00' + _CHARFORMAT_ID.pack(len(_charformat_reprs) - 1)
+        _charformat_frames[charformat] = frame
+        return frame
+
+
+def _repr_frame(charformat):
+    if isinstance(charformat, str):
+        return charformat.encode('utf8')
+    return repr(charformat).encode('utf8')
+
+
+def charformat_repr_from_frame(frame):
+    """Return the charformat repr for a charformat frame received by an OutputBox"""
+    if frame[:1] == b'\x00':
+        try:
+            return _charformat_reprs[_CHARFORMAT_ID.unpack(frame[1:])[0]]
+        except (struct.error, IndexError):
+            # Bad charformat id. Ignore and print unformatted
+            return 'stdout'
+    try:
+        return frame.decode('utf8')
+    except UnicodeDecodeError:
+        # Bad charformat repr. Ignore and print unformatted
+        return 'stdout'
+
+
+@functools.lru_cache(maxsize=CHARFORMAT_CACHE_SIZE)
+def charformats(charformat_repr):
+    """Return a QTextCharFormat for the given charformat repr. Results are cached, with
+    cache statistics available from charformats.cache_info()"""
     try:
         color, bold, italic = FORMAT_ALIASES[charformat_repr]
     except KeyError:
@@ -90,10 +160,31 @@ def charformats(charformat_repr):
     fmt = QTextCharFormat()
     fmt.setForeground(QBrush(qcolor))
     fmt.setFont(font)
-    _charformats[charformat_repr] = fmt
     return fmt
 
 
+class VisibilityWatcher(QObject):
+    """Calls callback(hidden) in the main thread whenever the widget is shown or
+    hidden, including by its window being minimised or restored, or it being in a tab
+    that is switched to or from. The callback must be a bound method, and is only
+    weakly referenced, so that the widget does not keep its instance alive"""
+
+    def __init__(self, widget, callback):
+        QObject.__init__(self, widget)
+        self.callback = weakref.WeakMethod(callback)
+        widget.installEventFilter(self)
+
+    def eventFilter(self, obj, event):
+        callback = self.callback()
+        if callback is None:
+            pass
+        elif event.type() == QEvent.Type.Show:
+            callback(False)
+        elif event.type() == QEvent.Type.Hide:
+            callback(True)
+        return False
+
+
 class OutputBox(object):
 
     # enum for keeping track of partial lines and carriage returns:
@@ -101,32 +192,70 @@ class OutputBox(object):
     LINE_MID = 1
     LINE_NEW = 2
 
-    # Max number of lines to batch before printing to the GUI, to keep the GUI
-    # responsive when lots of data comes in
-    MAX_LINES_BATCH = 10
+    # Range of the number of lines to batch before printing to the GUI. When the GUI is
+    # keeping up with the output, text is printed as soon as there is no more waiting to
+    # be read, and batches are at most MIN_LINES_BATCH lines. When the GUI falls behind,
+    # the maximum batch size doubles each batch, up to MAX_LINES_BATCH, so that it can
+    # catch up with fewer, larger insertions, and halves again once it has caught up:
+    MIN_LINES_BATCH = 10
+    MAX_LINES_BATCH = 10000
+
+    # Max number of bytes to batch before printing to the GUI, regardless of the number
+    # of lines:
+    MAX_BATCH_BYTES = 1 << 20
+
+    # Max time, in seconds, to wait for further text to add to a batch whilst the GUI
+    # is still busy printing the previous one:
+    MAX_BATCH_LATENCY = 0.016
+
+    # What to do with incoming text when more than max_queued_bytes of it is waiting to
+    # be printed: block writers until the GUI catches up, drop the oldest or newest
+    # waiting text, or drop the newest text and print a summary of what was dropped:
+    OVERFLOW_POLICIES = ('block', 'drop_oldest', 'drop_newest', 'summarize')
 
     # Declare that our write() method accepts a 'charformat' kwarg for specifying
     # formatting
     supports_rich_write = True
 
     def __init__(self, container, scrollback_lines=1000,
-                 zmq_context=None, bind_address='tcp://127.0.0.1'):
+                 zmq_context=None, bind_address='tcp://127.0.0.1', ipc=False,
+                 rcvhwm=1000, max_queued_bytes=32 << 20, overflow_policy='block',
+                 dispatcher=None):
         """Instantiate an outputBox and insert into container widget. Set the
         number of lines of scrollback to keep. Set a zmq_context for creating
         sockets, otherwise zmq.Context.instance() will be used. set
-        bind_address, defaulting to the local interface."""
-        self.output_textedit = QPlainTextEdit()
-        container.addWidget(self.output_textedit)
-        self.output_textedit.setReadOnly(True)
-        palette = self.output_textedit.palette()
-        palette.setColor(QPalette.ColorRole.Base, QColor(BACKGROUND))
-        self.output_textedit.setPalette(palette)
+        bind_address, defaulting to the local interface. If ipc is True, also bind
+        to an ipc:// endpoint in the temporary directory, which is faster than TCP
+        for other processes on the same machine, or if ipc is a string, bind to that
+        ipc:// endpoint. The endpoints other processes may connect to are listed,
+        fastest first, in the endpoints attribute, and the fastest is also
+        available as the endpoint attribute.
+
+        Memory used by output waiting to be printed is bounded by rcvhwm, the
+        maximum number of messages buffered by the receiving socket, beyond which
+        writers in other threads and processes block, and by max_queued_bytes, the
+        maximum amount of received text waiting for the GUI, beyond which
+        overflow_policy applies, see OVERFLOW_POLICIES. Writes from the main thread
+        never block, and are instead dropped if the socket is full. The number of
+        lines and bytes dropped are counted in the dropped_lines and dropped_bytes
+        attributes.
 
+        If dispatcher is an OutputBoxDispatcher, text is received by its thread,
+        shared with other OutputBoxes, rather than by a thread of our own.
+
+        Whilst the box is hidden, for example in a background tab or a minimised
+        window, text is not printed, and only the last scrollback_lines lines of it are
+        kept, to be printed in one go when the box is shown. Since the GUI will not
+        catch up until then, the 'block' policy drops the oldest text instead of
+        blocking whilst hidden, as does 'drop_oldest'."""
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            msg = 'overflow_policy must be one of %s' % ', '.join(self.OVERFLOW_POLICIES)
+            raise ValueError(msg)
+        self.max_queued_bytes = max_queued_bytes
+        self.overflow_policy = overflow_policy
         self.linepos = self.LINE_NEW
-        self.output_textedit.setBackgroundVisible(False)
-        self.output_textedit.setWordWrapMode(QTextOption.WrapMode.WrapAnywhere)
-        set_auto_scroll_to_end(self.output_textedit.verticalScrollBar())
-        self.output_textedit.setMaximumBlockCount(scrollback_lines)
+        self.scrollback_lines = scrollback_lines
+        widget = self._create_widget(container)
 
         if zmq_context is None:
             zmq_context = zmq.Context.instance()
@@ -134,8 +263,31 @@ class OutputBox(object):
 
         socket = self.zmq_context.socket(zmq.PULL)
         socket.setsockopt(zmq.LINGER, 0)
+        socket.setsockopt(zmq.RCVHWM, rcvhwm)
 
         self.port = socket.bind_to_random_port(bind_address)
+        self.endpoints = [socket.getsockopt_string(zmq.LAST_ENDPOINT)]
+
+        # Path of the socket file we created, if any, to delete at shutdown:
+        self._ipc_path = None
+        if ipc is True:
+            if not zmq.has('ipc'):
+                raise ValueError('ipc transport not supported on this platform')
+            self._ipc_path = os.path.join(
+                tempfile.gettempdir(),
+                'qtutils-outputbox-%d-%d' % (os.getpid(), next(_inproc_ids)),
+            )
+            ipc = 'ipc://' + self._ipc_path
+        if ipc:
+            socket.bind(ipc)
+            self.endpoints.insert(0, ipc)
+        self.endpoint = self.endpoints[0]
+
+        # Writers in this process connect to an inproc endpoint, so that their output
+        # is passed in memory rather than via the network stack. Only other processes
+        # use the port:
+        self.inproc_endpoint = 'inproc://qtutils-outputbox-%d' % next(_inproc_ids)
+        socket.bind(self.inproc_endpoint)
 
         # Thread-local storage so we can have one push_sock per thread.
         # push_sock is for sending data to the output queue in a non-blocking
@@ -154,18 +306,64 @@ class OutputBox(object):
         # as an argument directly to self.add_text() is so that self.shutdown() can call
         # self.add_text repeatedly to synchronously finish adding pending text to the
         # box. Otherwise, one cannot shutdown in a race-free way that does not deadlock.
-        self._text_queue = queue.Queue()
+        self._text_queue = collections.deque()
+
+        # Number of bytes of text in self._text_queue, and a condition for waiting for
+        # it to decrease. The lock also protects self._text_queue itself, and the counts
+        # of dropped text:
+        self._queued_bytes = 0
+        self._queue_condition = threading.Condition()
+        self.dropped_lines = 0
+        self.dropped_bytes = 0
+        # Counts of dropped text not yet summarised in the box, for the 'summarize'
+        # overflow policy:
+        self._unsummarized_lines = 0
+        self._unsummarized_bytes = 0
+
+        # Current maximum number of lines per batch, see MIN_LINES_BATCH:
+        self._lines_batch = self.MIN_LINES_BATCH
+
+        # Whilst the widget is hidden or its window minimised, text is not printed, but
+        # kept queued, limited to the last scrollback_lines lines, and printed in one
+        # go once the widget is shown. Protected by self._queue_condition:
+        self._hidden = not widget.isVisible() or widget.window().isMinimized()
+        self._visibility_watcher = VisibilityWatcher(widget, self._set_hidden)
 
         self.shutting_down = False
+        # Set once the socket has been closed after receiving the shutdown message:
+        self._receiver_done = threading.Event()
+        self.dispatcher = dispatcher
+        if dispatcher is not None:
+            self.mainloop_thread = None
+            dispatcher.register(self, socket)
+            return
         self.mainloop_thread = threading.Thread(target=self.mainloop, args=(socket,))
         self.mainloop_thread.daemon = True
         self.mainloop_thread.start()
 
+    def _create_widget(self, container):
+        self.output_textedit = QPlainTextEdit()
+        container.addWidget(self.output_textedit)
+        self.output_textedit.setReadOnly(True)
+        palette = self.output_textedit.palette()
+        palette.setColor(QPalette.ColorRole.Base, QColor(BACKGROUND))
+        self.output_textedit.setPalette(palette)
+        self.output_textedit.setBackgroundVisible(False)
+        self.output_textedit.setWordWrapMode(QTextOption.WrapMode.WrapAnywhere)
+        set_auto_scroll_to_end(self.output_textedit.verticalScrollBar())
+        self.output_textedit.setMaximumBlockCount(self.scrollback_lines)
+        return self.output_textedit
+
     def new_socket(self):
         # One socket per thread, so we don't have to acquire a lock
         # to send:
         self.local.push_sock = self.zmq_context.socket(zmq.PUSH)
-        self.local.push_sock.connect('tcp://127.0.0.1:%d' % self.port)
+        self.local.push_sock.connect(self.inproc_endpoint)
+        # The main thread must not block waiting for itself to print text:
+        if threading.current_thread() is threading.main_thread():
+            self.local.send_flags = zmq.NOBLOCK
+        else:
+            self.local.send_flags = 0
 
     def write(self, text, color=WHITE, bold=False, italic=False, charformat=None):
         """Write to the output box as if it were a file. Takes a string as does not
@@ -177,10 +375,17 @@ class OutputBox(object):
             self.new_socket()
         # Queue the output on the socket:
         if charformat is None:
-            charformat = repr((color, bold, italic)).encode('utf8')
+            charformat = charformat_frame((color, bold, italic))
         elif isinstance(charformat, str):
-            charformat = charformat.encode('utf8')
-        self.local.push_sock.send_multipart([charformat, text.encode('utf8')])
+            charformat = charformat_frame(charformat)
+        # Lone surrogates, such as from undecodable filenames, are printed as escape
+        # sequences, as are undecodable bytes by the receiver:
+        text = text.encode('utf8', 'backslashreplace')
+        try:
+            self.local.push_sock.send_multipart([charformat, text], self.local.send_flags)
+        except zmq.Again:
+            with self._queue_condition:
+                self._count_dropped(text.count(b'\n'), len(text))
 
     def print(self, *values, **kwargs):
         """Print to the output box. This method accepts the same arguments as the Python
@@ -226,54 +431,274 @@ class OutputBox(object):
         self.write(text, color=color, bold=bold)
 
     def mainloop(self, socket):
+        shutdown = False
+        while not shutdown:
+            # Wait for messages. If there is a summary of dropped text waiting to be
+            # printed, don't wait indefinitely, and print it once there is room:
+            if self._unsummarized_lines or self._unsummarized_bytes:
+                if not socket.poll(100):
+                    if self._queue_batch([]):
+                        self.add_text()
+                    continue
+            else:
+                socket.poll()
+            batch, shutdown = self._receive(socket, wait=True)
+            if self._queue_batch(batch):
+                self.add_text()
+        self._close_socket(socket)
+
+    def _receive(self, socket, wait):
+        """Receive a batch of text from the socket, returning it as a list of (text,
+        charformat_repr) tuples, and whether the shutdown message was received. If
+        wait is True, and the GUI is still busy printing the previous batch, wait up to
+        MAX_BATCH_LATENCY for more text to add to this one"""
+        shutdown = False
+        messages = []
+        current_charformat = None
+        deadline = time.monotonic() + self.MAX_BATCH_LATENCY
+        # Get all messages waiting in the pipe, concatenate strings to
+        # reduce the number of times we call add_text (which requires posting
+        # to the qt main thread, which can be a bottleneck when there is a lot of output)
+        n_lines = 0
+        n_bytes = 0
         while True:
-            messages = []
-            current_charformat = None
-            # Wait for messages
-            socket.poll()
-            # Get all messages waiting in the pipe, concatenate strings to
-            # reduce the number of times we call add_text (which requires posting
-            # to the qt main thread, which can be a bottleneck when there is a lot of output)
-            n_lines = 0
-            while True:
-                try:
-                    charformat_repr, text = socket.recv_multipart(zmq.NOBLOCK)
-                    if text == b'shutdown' and self.shutting_down:
-                        socket.close(linger=0)
-                        return
-                except zmq.Again:
+            try:
+                # Don't copy frames, text is decoded directly from the zmq buffer:
+                charformat_frame, text_frame = socket.recv_multipart(
+                    zmq.NOBLOCK, copy=False
+                )
+                charformat_repr = charformat_frame.bytes
+                if text_frame.buffer == b'shutdown' and self.shutting_down:
+                    # Text sent by other threads before the shutdown message may still
+                    # be waiting in their own pipes to the socket. Receive all that is
+                    # waiting, and queue it before returning:
+                    shutdown = True
+                    continue
+            except zmq.Again:
+                # Nothing more waiting. If the GUI is idle, print what we have
+                # immediately. Otherwise, wait a little for more text to arrive, as
+                # it won't be printed before the GUI is done with the previous
+                # batch anyway:
+                if shutdown or not wait or not self._text_queue:
                     break
-                if charformat_repr != current_charformat:
-                    current_charformat = charformat_repr
-                    current_message = []
-                    messages.append((current_charformat, current_message))
-                current_message.append(text)
-                n_lines += text.count(b'\n')
-                if n_lines >= self.MAX_LINES_BATCH:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0 or not socket.poll(1000 * timeout):
                     break
-            for charformat_repr, message in messages:
-                # Print non-character data with replacement sequences:
-                text = b''.join(message).decode('utf8', errors='backslashreplace')
-                try:
-                    charformat_repr = charformat_repr.decode('utf8')
-                except UnicodeDecodeError:
-                    # Bad charformat repr. Ignore and print unformatted
-                    charformat_repr = 'stdout'
-                # Queue a call to self.add_text, and put the pending text in the queue
-                # for it to consume. A separate queue is used so that a call to
-                # self.shutdown() can call _add_text to add the remaining text
-                # synchronously in order to make shutdown synchronous.
-                self._text_queue.put((text, charformat_repr))
-                self.add_text()
+                continue
+            if charformat_repr != current_charformat:
+                current_charformat = charformat_repr
+                current_message = []
+                # An incremental decoder, so that characters split between
+                # messages are decoded correctly. Non-character data is printed
+                # with replacement sequences:
+                decoder = codecs.getincrementaldecoder('utf8')('backslashreplace')
+                messages.append((current_charformat, decoder, current_message))
+            text = decoder.decode(text_frame.buffer)
+            current_message.append(text)
+            n_lines += text.count('\n')
+            n_bytes += len(text_frame)
+            if shutdown:
+                continue
+            if n_lines >= self._lines_batch or n_bytes >= self.MAX_BATCH_BYTES:
+                break
+        # Adapt the batch size to how well the GUI is keeping up:
+        if self._text_queue:
+            self._lines_batch = min(2 * self._lines_batch, self.MAX_LINES_BATCH)
+        else:
+            self._lines_batch = max(self._lines_batch // 2, self.MIN_LINES_BATCH)
+        batch = []
+        for charformat_repr, decoder, message in messages:
+            message.append(decoder.decode(b'', final=True))
+            text = ''.join(message)
+            batch.append((text, charformat_repr_from_frame(charformat_repr)))
+        return batch, shutdown
+
+    def _close_socket(self, socket):
+        socket.close(linger=0)
+        if self._ipc_path is not None:
+            try:
+                os.unlink(self._ipc_path)
+            except OSError:
+                pass
+        self._receiver_done.set()
+
+    def _count_dropped(self, n_lines, n_bytes):
+        # Must be called with self._queue_condition held
+        self.dropped_lines += n_lines
+        self.dropped_bytes += n_bytes
+        if self.overflow_policy == 'summarize':
+            self._unsummarized_lines += n_lines
+            self._unsummarized_bytes += n_bytes
+
+    def _queue_batch(self, batch, block=True):
+        """Queue a batch of text to be printed, applying the overflow policy if there
+        is too much text already queued. If block is False, the 'block' policy does not
+        wait for room, and it is up to the caller to stop receiving text instead.
+        Return whether a new plan was queued, requiring a call to add_text()"""
+        n_bytes = sum(len(text) for text, _ in batch)
+        n_lines = sum(text.count('\n') for text, _ in batch)
+        with self._queue_condition:
+            if self.overflow_policy == 'block':
+                # Wait for room, though always allow a batch into an empty queue,
+                # however large it is. Don't wait if shutting down, as the main thread
+                # may be waiting for us, or if hidden, as it won't print any more:
+                while (
+                    block
+                    and self._queued_bytes
+                    and self._queued_bytes + n_bytes > self.max_queued_bytes
+                    and not self.shutting_down
+                    and not self._hidden
+                ):
+                    self._queue_condition.wait()
+            elif self.overflow_policy == 'drop_oldest':
+                # Whilst hidden, the oldest text is instead trimmed from the queued
+                # plan, see _limit_hidden_plan():
+                while not self._hidden and self._text_queue and (
+                    self._queued_bytes + n_bytes > self.max_queued_bytes
+                ):
+                    _, old_n_bytes, old_n_lines = self._text_queue.popleft()
+                    self._queued_bytes -= old_n_bytes
+                    self._count_dropped(old_n_lines, old_n_bytes)
+            elif self._queued_bytes + n_bytes > self.max_queued_bytes:
+                # drop_newest or summarize:
+                self._count_dropped(n_lines, n_bytes)
+                batch = []
+                n_bytes = n_lines = 0
+            if self._unsummarized_lines or self._unsummarized_bytes:
+                if self._queued_bytes < self.max_queued_bytes:
+                    summary = '[%d lines (%d bytes) suppressed]\n' % (
+                        self._unsummarized_lines,
+                        self._unsummarized_bytes,
+                    )
+                    batch.insert(0, (summary, 'WARNING'))
+                    n_bytes += len(summary)
+                    n_lines += 1
+                    self._unsummarized_lines = self._unsummarized_bytes = 0
+        if not batch:
+            return False
+        # Turn the text into a plan of operations on the box here, in the receiver
+        # thread, so that the main thread need only apply it:
+        ops = []
+        for text, charformat_repr in batch:
+            self._plan_text(text, charformat_repr, ops)
+        with self._queue_condition:
+            self._queued_bytes += n_bytes
+            if self._text_queue and (
+                self._hidden or self._text_queue[-1][1] + n_bytes <= self.MAX_BATCH_BYTES
+            ):
+                # The previous plan has not been applied yet. Add to it instead of
+                # queueing another, so that any of its lines overwritten by this batch
+                # after a carriage return are never printed at all. There is already
+                # a call to self.add_text queued for it, or if hidden, it will be
+                # printed when shown:
+                old_ops, old_n_bytes, old_n_lines = self._text_queue[-1]
+                self._extend_plan(old_ops, ops)
+                self._text_queue[-1] = self._limit_hidden_plan(
+                    old_ops, old_n_bytes + n_bytes, old_n_lines + n_lines
+                )
+                return False
+            # Put the pending plan in the queue for a call to self.add_text to
+            # consume. A separate queue is used so that a call to self.shutdown() can
+            # call _add_text to add the remaining text synchronously in order to make
+            # shutdown synchronous.
+            self._text_queue.append(self._limit_hidden_plan(ops, n_bytes, n_lines))
+            # No call to add_text is needed if hidden:
+            return not self._hidden
+
+    def _limit_hidden_plan(self, ops, n_bytes, n_lines):
+        """If hidden, remove operations from the start of the queued plan ops that
+        only add lines that will be scrolled out of the box by the rest of the plan
+        when it is printed. This is done once the plan has twice as many lines as the
+        scrollback, so that its cost is proportional to the amount of text. Then, for
+        the 'block' and 'drop_oldest' overflow policies, drop the oldest text of the
+        plan if there is more than max_queued_bytes queued. Return the queue item
+        (ops, n_bytes, n_lines) with the counts updated. Must be called with
+        self._queue_condition held"""
+        if not self._hidden:
+            return ops, n_bytes, n_lines
+        if n_lines > 2 * self.scrollback_lines:
+            new_lines = [
+                i for i, (linepos, _, _) in enumerate(ops) if linepos == self.LINE_NEW
+            ]
+            if len(new_lines) > self.scrollback_lines:
+                # Keep the last scrollback_lines lines, which replace all existing
+                # lines in the box, so operations on those lines need not be kept
+                # either:
+                start = new_lines[-self.scrollback_lines]
+                # Count line endings as well as text:
+                removed_bytes = min(
+                    sum(len(text) + 1 for _, text, _ in ops[:start]), n_bytes
+                )
+                del ops[:start]
+                self._queued_bytes -= removed_bytes
+                n_bytes -= removed_bytes
+                n_lines = max(n_lines - len(new_lines) + self.scrollback_lines, 0)
+        excess = min(self._queued_bytes - self.max_queued_bytes, n_bytes)
+        if excess <= 0 or self.overflow_policy not in ('block', 'drop_oldest'):
+            # The other policies have already dropped new text if there was too much:
+            return ops, n_bytes, n_lines
+        # Drop whole operations from the start of the plan, and then if necessary the
+        # start of the text of the last one, which may be a long partial line:
+        removed_bytes = 0
+        removed_lines = 0
+        start = 0
+        while start < len(ops) - 1 and removed_bytes < excess:
+            linepos, text, _ = ops[start]
+            removed_bytes += len(text) + 1
+            removed_lines += linepos == self.LINE_NEW
+            start += 1
+        del ops[:start]
+        linepos, text, charformat_repr = ops[0]
+        if removed_bytes < excess:
+            text = text[excess - removed_bytes :]
+            removed_bytes = excess
+        if start:
+            # The start of the first remaining line has been dropped, print what is
+            # left of it as a new line:
+            linepos = self.LINE_NEW
+        ops[0] = (linepos, text, charformat_repr)
+        removed_bytes = min(removed_bytes, n_bytes)
+        self._queued_bytes -= removed_bytes
+        self._count_dropped(removed_lines, removed_bytes)
+        return ops, n_bytes - removed_bytes, max(n_lines - removed_lines, 0)
 
     @inmain_decorator(False)
     def add_text(self):
-        try:
-            text, charformat_repr = self._text_queue.get()
-        except queue.Empty:
-            # self.shutdown(), or some other additional calls to this method, have
-            # beaten us to the punch. Nothing for us to do.
-            return
+        self._add_text()
+
+    def _add_text(self):
+        with self._queue_condition:
+            if not self._text_queue:
+                # self.shutdown(), or some other additional calls to this method, have
+                # beaten us to the punch. Nothing for us to do.
+                return
+            if self._hidden:
+                # Leave the text queued until we are shown:
+                return
+            ops, n_bytes, _ = self._text_queue.popleft()
+            self._queued_bytes -= n_bytes
+            self._queue_condition.notify_all()
+        self._apply_plan(ops)
+
+    def _set_hidden(self, hidden):
+        """Called in the main thread when the widget is hidden or shown"""
+        with self._queue_condition:
+            self._hidden = hidden
+            # Waiting for room in the queue is pointless now if hidden:
+            self._queue_condition.notify_all()
+            # Text queued whilst hidden may have no call to self.add_text queued for
+            # it. Print it all now. Any further text queued in the meantime will have:
+            n_queued = 0 if hidden else len(self._text_queue)
+        for _ in range(n_queued):
+            self._add_text()
+
+    def _plan_text(self, text, charformat_repr, ops):
+        """Append to the list ops the operations required to add text to the box,
+        updating self.linepos to the line position following the text. Each
+        operation is a tuple (linepos, text, charformat_repr) of a line or partial
+        line to add to the box, without line endings. For linepos LINE_NEW the text
+        is added as a new line, for LINE_MID it is appended to the last line, and for
+        LINE_START it replaces the last line."""
         # The convoluted logic below is because we want a few things that conflict
         # slightly. Firstly, we want to take advantage of our setMaximumBlockCount
         # setting; Qt will automatically remove old lines, but only if each line is a
@@ -288,29 +713,10 @@ class OutputBox(object):
         # would do, it returns to the start of the line but overwrites the whole line no
         # matter how much is printed, rather than only overwriting up to what new is
         # printed. I expect this difference not to matter too much!
-        cursor = self.output_textedit.textCursor()
         lines = text.splitlines(True) # This keeps the line endings in the strings!
-        cursor = self.output_textedit.textCursor()
-        prevline_len = 0
-        charsprinted = 0
         for line in lines:
-            cursor.movePosition(QTextCursor.MoveOperation.End)
             thisline = line.rstrip('\r\n') # Remove any of \r, \n or \r\n
-            if self.linepos == self.LINE_START:    # Previous line ended in a carriage return. 
-                cursor.movePosition(QTextCursor.MoveOperation.StartOfBlock, QTextCursor.MoveMode.KeepAnchor) # "Highlight" the text to be overwritten
-                cursor.insertText(thisline)
-                charsprinted -= prevline_len # We are replacing the previous line...
-                prevline_len = len(thisline) # Reset the line length to this overwriting line
-            elif self.linepos == self.LINE_MID:
-                cursor.insertText(thisline)
-                prevline_len += len(thisline)
-            elif self.linepos == self.LINE_NEW:
-                self.output_textedit.appendPlainText(thisline)
-                charsprinted += 1  # Account for newline character here
-                prevline_len = len(thisline)
-            else:
-                raise ValueError(self.linepos)
-            charsprinted += len(thisline)
+            self._add_op(ops, self.linepos, thisline, charformat_repr)
             # Set the line position for the next line, whenever that arrives
             if '\n' in line:
                 self.linepos = self.LINE_NEW
@@ -318,21 +724,97 @@ class OutputBox(object):
                 self.linepos = self.LINE_START
             else:
                 self.linepos = self.LINE_MID
-            cursor.movePosition(QTextCursor.MoveOperation.End)
-            cursor.movePosition(QTextCursor.MoveOperation.PreviousCharacter, n=charsprinted)
-            cursor.movePosition(QTextCursor.MoveOperation.End, QTextCursor.MoveMode.KeepAnchor)
-            cursor.setCharFormat(charformats(charformat_repr))
-        
+
+    def _add_op(self, ops, linepos, text, charformat_repr):
+        """Append an operation to the list ops, combining it with earlier operations
+        where possible"""
+        if linepos == self.LINE_START:
+            # Only the result of overwriting a line can ever be seen, so remove any
+            # earlier operations on the same line:
+            while ops and ops[-1][0] != self.LINE_NEW:
+                ops.pop()
+            if ops:
+                # The line was started by an operation in this plan. Start it with
+                # this text instead:
+                ops[-1] = (self.LINE_NEW, text, charformat_repr)
+            else:
+                ops.append((self.LINE_START, text, charformat_repr))
+        elif linepos == self.LINE_MID and ops and ops[-1][2] == charformat_repr:
+            # Merge with the previous operation, which ends on the same line:
+            prev_linepos, prev_text, _ = ops[-1]
+            ops[-1] = (prev_linepos, prev_text + text, charformat_repr)
+        else:
+            ops.append((linepos, text, charformat_repr))
+
+    def _extend_plan(self, ops, new_ops):
+        """Append the operations of the plan new_ops to the plan ops"""
+        for i, op in enumerate(new_ops):
+            if op[0] == self.LINE_NEW:
+                # The rest can't be combined with anything in ops:
+                ops.extend(new_ops[i:])
+                return
+            self._add_op(ops, *op)
+
+    def _apply_plan(self, ops):
+        """Add text to the box according to a list of operations from _plan_text(),
+        as a single edit of the document"""
+        if not ops:
+            return
+        document = self.output_textedit.document()
+        cursor = QTextCursor(document)
+        cursor.beginEditBlock()
+        # Lines that would be immediately removed again by the document's maximum block
+        # count need not be inserted at all. If there are enough new lines to replace
+        # the entire document, clear it and add only the ones that will be kept. This is
+        # skipped if the document has only one block, since then it may be or become
+        # empty, in which case new lines do not start new blocks (see below), and
+        # counting blocks is not so simple:
+        new_lines = [i for i, (linepos, _, _) in enumerate(ops) if linepos == self.LINE_NEW]
+        trimmed = len(new_lines) >= self.scrollback_lines and document.blockCount() > 1
+        if trimmed:
+            ops = ops[new_lines[-self.scrollback_lines]:]
+            cursor.select(QTextCursor.SelectionType.Document)
+            cursor.removeSelectedText()
+            # The first line goes in the now-empty first block:
+            _, text, charformat_repr = ops[0]
+            ops[0] = (self.LINE_MID, text, charformat_repr)
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        for linepos, text, charformat_repr in ops:
+            if linepos == self.LINE_START:
+                # "Highlight" the text to be overwritten:
+                cursor.movePosition(
+                    QTextCursor.MoveOperation.StartOfBlock,
+                    QTextCursor.MoveMode.KeepAnchor,
+                )
+            elif linepos == self.LINE_NEW and (trimmed or not document.isEmpty()):
+                # Like appendPlainText(), only start a new block if the document is not
+                # empty:
+                cursor.insertBlock()
+            cursor.insertText(text, charformats(charformat_repr))
+        cursor.endEditBlock()
+
     def shutdown(self):
         """Stop the mainloop. Further writing to the OutputBox will be ignored. It is
         necessary to call this when done to prevent memory leaks, otherwise the mainloop
         thread will prevent the OutputBox from being garbage collected"""
-        self.shutting_down = True
-        self.write("shutdown")
-        self.mainloop_thread.join()
+        with self._queue_condition:
+            self.shutting_down = True
+            self._queue_condition.notify_all()
+        if not hasattr(self.local, 'push_sock'):
+            self.new_socket()
+        # Send without the NOBLOCK flag, since we need this message to arrive. It is
+        # safe to block even in the main thread now that the receiver won't wait for us:
+        self.local.push_sock.send_multipart([b'stdout', b'shutdown'])
+        if self.mainloop_thread is not None:
+            self.mainloop_thread.join()
+        else:
+            self._receiver_done.wait()
+        # Print text even if hidden:
+        with self._queue_condition:
+            self._hidden = False
         # Print queued text to the box until there is none left:
-        while not self._text_queue.empty():
-            self.add_text()
+        while self._text_queue:
+            inmain(self._add_text)
         self.shutting_down = False
 
     # Ensure instances can be treated as a file-like object:
@@ -349,6 +831,641 @@ class OutputBox(object):
         pass
 
 
+class OutputBoxDispatcher(object):
+    """Receives text for any number of OutputBoxes in a single thread, polling all
+    their sockets at once, and prints the text received for all of them with a single
+    call in the main thread at a time. This saves threads and main thread wakeups in
+    applications with many OutputBoxes. Pass an instance as the dispatcher argument to
+    each OutputBox that is to share it. Each OutputBox must still be shut down
+    individually with its shutdown() method.
+
+    Since the shared thread must not wait for any one OutputBox's GUI to catch up, the
+    'block' overflow policy is implemented by not receiving from an OutputBox's socket
+    whilst it has max_queued_bytes or more waiting to be printed, and so may exceed it
+    by one batch."""
+
+    # How often, in seconds, to check whether OutputBoxes that are not being received
+    # from have room for more text, and whether summaries of dropped text can be
+    # printed:
+    RETRY_INTERVAL = 0.1
+
+    def __init__(self, zmq_context=None):
+        if zmq_context is None:
+            zmq_context = zmq.Context.instance()
+        self.zmq_context = zmq_context
+        # A socket for telling the thread about new OutputBoxes, and to shut down:
+        self.control_endpoint = 'inproc://qtutils-outputbox-dispatcher-%d' % next(
+            _inproc_ids
+        )
+        control = self.zmq_context.socket(zmq.PULL)
+        control.bind(self.control_endpoint)
+        # One control socket per thread, as for OutputBox.local:
+        self.local = threading.local()
+        # The lock protects the following two lists:
+        self._lock = threading.Lock()
+        # (box, socket) tuples to be added to the poller:
+        self._new_boxes = []
+        # OutputBoxes with plans queued, each listed once per call to its _add_text()
+        # that is required:
+        self._pending = []
+        self.thread = threading.Thread(target=self.mainloop, args=(control,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _send_control(self, message):
+        if not hasattr(self.local, 'control_sock'):
+            self.local.control_sock = self.zmq_context.socket(zmq.PUSH)
+            self.local.control_sock.connect(self.control_endpoint)
+        self.local.control_sock.send(message)
+
+    def register(self, box, socket):
+        """Start receiving text for the OutputBox from the given socket. Called by
+        the OutputBox. The socket is thereafter used only by our thread, until closed
+        by it upon receiving the OutputBox's shutdown message"""
+        with self._lock:
+            self._new_boxes.append((box, socket))
+        self._send_control(b'register')
+
+    def shutdown(self):
+        """Stop the thread. OutputBoxes using this dispatcher should be shut down
+        first, as no more text will be received for them"""
+        self._send_control(b'shutdown')
+        self.thread.join()
+
+    def mainloop(self, control):
+        poller = zmq.Poller()
+        poller.register(control, zmq.POLLIN)
+        # {socket: box} for the sockets being polled:
+        boxes = {}
+        # {socket: box} for the sockets not being received from until their
+        # OutputBoxes have room for more text:
+        throttled = {}
+        while True:
+            # If there are throttled boxes or summaries of dropped text waiting to be
+            # printed, don't wait indefinitely:
+            if throttled or any(
+                box._unsummarized_lines or box._unsummarized_bytes
+                for box in boxes.values()
+            ):
+                events = dict(poller.poll(1000 * self.RETRY_INTERVAL))
+            else:
+                events = dict(poller.poll())
+            if control in events:
+                while True:
+                    try:
+                        message = control.recv(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    if message == b'shutdown':
+                        control.close(linger=0)
+                        return
+                with self._lock:
+                    new_boxes = self._new_boxes
+                    self._new_boxes = []
+                for box, socket in new_boxes:
+                    boxes[socket] = box
+                    poller.register(socket, zmq.POLLIN)
+            for socket, box in list(throttled.items()):
+                # Resume receiving once there is room, or if shutting down, since
+                # then the main thread may be waiting for the shutdown message to be
+                # received rather than printing text, or if hidden, since then queued
+                # text is limited to the scrollback instead:
+                if (
+                    box.shutting_down
+                    or box._hidden
+                    or box._queued_bytes < box.max_queued_bytes
+                ):
+                    del throttled[socket]
+                    boxes[socket] = box
+                    poller.register(socket, zmq.POLLIN)
+            pending = []
+            for socket, box in list(boxes.items()):
+                if socket in events:
+                    batch, shutdown = box._receive(socket, wait=False)
+                elif box._unsummarized_lines or box._unsummarized_bytes:
+                    batch, shutdown = [], False
+                else:
+                    continue
+                if box._queue_batch(batch, block=False):
+                    pending.append(box)
+                if shutdown:
+                    poller.unregister(socket)
+                    del boxes[socket]
+                    box._close_socket(socket)
+                elif (
+                    box.overflow_policy == 'block'
+                    and box._queued_bytes >= box.max_queued_bytes
+                    and not box.shutting_down
+                    and not box._hidden
+                ):
+                    poller.unregister(socket)
+                    del boxes[socket]
+                    throttled[socket] = box
+            if pending:
+                with self._lock:
+                    self._pending.extend(pending)
+                # If a call is already waiting to be run, it will print these too:
+                inmain_later(self._render, coalesce=True)
+
+    def _render(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+        for box in pending:
+            box._add_text()
+
+
+class LineRing(object):
+    """A fixed-capacity buffer of lines, in which appending a line when full discards
+    the oldest. Each line is stored as its text and a tuple of (start, format id)
+    pairs, one for each run of text with the same format. Texts and runs are stored
+    in separate lists so that no per-line container object is needed, and lines
+    with a single run may share the same runs tuple."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.texts = []
+        self.runs = []
+        # Index in the lists of the oldest line, and number of lines:
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _index(self, i):
+        return (self.start + i) % self.capacity
+
+    def get(self, i):
+        j = self._index(i)
+        return self.texts[j], self.runs[j]
+
+    def set(self, i, text, runs):
+        j = self._index(i)
+        self.texts[j] = text
+        self.runs[j] = runs
+
+    def append(self, text, runs):
+        if self.count == self.capacity:
+            self.popleft(1)
+        j = self._index(self.count)
+        if j == len(self.texts):
+            # Not yet full, grow the lists:
+            self.texts.append(text)
+            self.runs.append(runs)
+        else:
+            self.texts[j] = text
+            self.runs[j] = runs
+        self.count += 1
+
+    def popleft(self, n):
+        """Discard the oldest n lines. Their slots are reused by later appends"""
+        self.start = self._index(n)
+        self.count -= n
+
+    def all_runs(self):
+        """Return a list of the runs of every line, oldest first"""
+        end = self.start + self.count
+        if end <= self.capacity:
+            return self.runs[self.start:end]
+        return self.runs[self.start:] + self.runs[:end - self.capacity]
+
+
+class LogModel(QAbstractListModel):
+    """A list model of the lines in a LineRing, with a registry of the formats
+    referred to by format ids in the lines' runs"""
+
+    # Max number of format ids in use at once:
+    MAX_FORMAT_IDS = MAX_CHARFORMAT_IDS
+
+    def __init__(self, capacity, parent=None):
+        QAbstractListModel.__init__(self, parent)
+        self.lines = LineRing(capacity)
+        # QTextCharFormats and their font metrics by format id, and format ids by
+        # charformat repr:
+        self.formats = []
+        self.metrics = []
+        self.format_ids = {}
+        # Ids of formats no longer in use, for reuse:
+        self.free_ids = []
+        # Ids handed out that may be in lines not yet added to the model:
+        self._pending_ids = set()
+        # Total lines appended, and the total after which unused format ids may next
+        # be reclaimed:
+        self.n_appended = 0
+        self._next_reclaim = 0
+        # A shared runs tuple for each format, for lines entirely in one format:
+        self._single_runs = {}
+        # The fallback format, which is never reclaimed:
+        self.plain_id = self.format_id('stdout')
+
+    def format_id(self, charformat_repr):
+        """Return the format id for the given charformat repr, assigning one if need
+        be. If MAX_FORMAT_IDS are already in use, ids no longer referred to by any
+        line are reclaimed. If there are none, the plain format's id is returned."""
+        try:
+            fmt_id = self.format_ids[charformat_repr]
+        except KeyError:
+            if not self.free_ids and len(self.formats) >= self.MAX_FORMAT_IDS:
+                self.reclaim_format_ids()
+            if self.free_ids:
+                fmt_id = self.free_ids.pop()
+            elif len(self.formats) < self.MAX_FORMAT_IDS:
+                fmt_id = len(self.formats)
+                self.formats.append(None)
+                self.metrics.append(None)
+            else:
+                return self.plain_id
+            fmt = charformats(charformat_repr)
+            self.formats[fmt_id] = fmt
+            self.metrics[fmt_id] = QFontMetricsF(fmt.font())
+            self.format_ids[charformat_repr] = fmt_id
+        self._pending_ids.add(fmt_id)
+        return fmt_id
+
+    def reclaim_format_ids(self):
+        """Free the ids of formats not referred to by any line. Since this requires
+        looking at every line, if none can be freed, don't try again until an eighth
+        of the buffer's capacity of further lines has been appended."""
+        if self.n_appended < self._next_reclaim:
+            return
+        in_use = {fmt_id for runs in set(self.lines.all_runs()) for _, fmt_id in runs}
+        in_use |= self._pending_ids
+        in_use.add(self.plain_id)
+        for charformat_repr, fmt_id in list(self.format_ids.items()):
+            if fmt_id not in in_use:
+                del self.format_ids[charformat_repr]
+                self.formats[fmt_id] = self.metrics[fmt_id] = None
+                self.free_ids.append(fmt_id)
+        if not self.free_ids:
+            self._next_reclaim = self.n_appended + max(1, self.lines.capacity // 8)
+
+    def compact_runs(self, runs):
+        """Return a tuple of the given list of runs, sharing it with other lines if
+        possible"""
+        if len(runs) == 1 and runs[0][0] == 0:
+            fmt_id = runs[0][1]
+            try:
+                return self._single_runs[fmt_id]
+            except KeyError:
+                return self._single_runs.setdefault(fmt_id, ((0, fmt_id),))
+        return tuple(runs)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.lines)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole:
+            return self.lines.get(index.row())[0]
+        return None
+
+    def set_last_line(self, text, runs):
+        row = len(self.lines) - 1
+        self.lines.set(row, text, runs)
+        self._pending_ids.clear()
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
+
+    def append_lines(self, lines):
+        """Append a list of (text, runs) lines, discarding the oldest lines if there is
+        not enough room"""
+        capacity = self.lines.capacity
+        lines = lines[-capacity:]
+        n_remove = len(self.lines) + len(lines) - capacity
+        if n_remove > 0:
+            self.beginRemoveRows(QModelIndex(), 0, n_remove - 1)
+            self.lines.popleft(n_remove)
+            self.endRemoveRows()
+        first = len(self.lines)
+        self.beginInsertRows(QModelIndex(), first, first + len(lines) - 1)
+        for text, runs in lines:
+            self.lines.append(text, runs)
+        self.n_appended += len(lines)
+        self._pending_ids.clear()
+        self.endInsertRows()
+
+
+class LogView(QAbstractScrollArea):
+    """A view of a LogModel that formats and paints only the visible lines, scrolling
+    by whole lines. Lines are painted run by run in each run's format, and are not
+    wrapped. Instead the view scrolls horizontally, as far as the widest line painted
+    so far. Unlike the Qt item views, which lay out every row, the cost of updating
+    the view does not depend on the number of lines. Whole lines can be selected with
+    the mouse, and copied with the usual keyboard shortcut."""
+
+    MARGIN = 4
+
+    def __init__(self, model, parent=None):
+        QAbstractScrollArea.__init__(self, parent)
+        self.model = model
+        self.line_height = QFontMetrics(charformats('stdout').font()).height()
+        # First and last selected rows, or None:
+        self.selection = None
+        # Width in pixels of the widest line painted so far:
+        self.content_width = 0
+        self.verticalScrollBar().setSingleStep(1)
+        self.verticalScrollBar().valueChanged.connect(self.viewport().update)
+        self.horizontalScrollBar().setSingleStep(
+            QFontMetrics(charformats('stdout').font()).averageCharWidth()
+        )
+        self.horizontalScrollBar().valueChanged.connect(self.viewport().update)
+        model.rowsInserted.connect(self.on_rows_inserted)
+        model.rowsRemoved.connect(self.on_rows_removed)
+        model.dataChanged.connect(self.on_data_changed)
+        copy_action = QAction('Copy', self)
+        copy_action.setShortcut(QKeySequence.StandardKey.Copy)
+        copy_action.setShortcutContext(Qt.ShortcutContext.WidgetWithChildrenShortcut)
+        copy_action.triggered.connect(self.copy_selection)
+        self.addAction(copy_action)
+
+    def visible_lines(self):
+        return max(1, self.viewport().height() // self.line_height)
+
+    def update_scrollbar(self):
+        scrollbar = self.verticalScrollBar()
+        visible_lines = self.visible_lines()
+        scrollbar.setPageStep(visible_lines)
+        scrollbar.setRange(0, max(0, self.model.rowCount() - visible_lines))
+        self.update_horizontal_scrollbar()
+
+    def update_horizontal_scrollbar(self):
+        scrollbar = self.horizontalScrollBar()
+        width = self.viewport().width()
+        scrollbar.setPageStep(width)
+        scrollbar.setRange(0, max(0, int(self.content_width) + 2 * self.MARGIN - width))
+
+    def on_rows_inserted(self, parent, first, last):
+        self.update_scrollbar()
+        self.viewport().update()
+
+    def on_rows_removed(self, parent, first, last):
+        n_removed = last - first + 1
+        scrollbar = self.verticalScrollBar()
+        if self.selection is not None:
+            start, end = (row - n_removed for row in self.selection)
+            self.selection = None if end < 0 else (max(start, 0), end)
+        # Lines are only removed from the start. Unless scrolled to the end, keep the
+        # same lines in view:
+        if scrollbar.value() != scrollbar.maximum():
+            scrollbar.setValue(scrollbar.value() - n_removed)
+        self.update_scrollbar()
+        self.viewport().update()
+
+    def on_data_changed(self, top_left, bottom_right):
+        first = self.verticalScrollBar().value()
+        if top_left.row() <= first + self.visible_lines() and bottom_right.row() >= first:
+            self.viewport().update()
+
+    def resizeEvent(self, event):
+        QAbstractScrollArea.resizeEvent(self, event)
+        self.update_scrollbar()
+
+    def row_at(self, y):
+        row = self.verticalScrollBar().value() + int(y) // self.line_height
+        return max(0, min(row, self.model.rowCount() - 1))
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.MouseButton.LeftButton and self.model.rowCount():
+            row = self.row_at(event.pos().y())
+            self.selection = (row, row)
+            self.viewport().update()
+
+    def mouseMoveEvent(self, event):
+        if event.buttons() & Qt.MouseButton.LeftButton and self.selection is not None:
+            self.selection = (self.selection[0], self.row_at(event.pos().y()))
+            self.viewport().update()
+
+    def copy_selection(self):
+        """Copy the text of the selected lines to the clipboard"""
+        if self.selection is None:
+            return
+        start, end = sorted(self.selection)
+        lines = self.model.lines
+        text = '\n'.join(lines.get(row)[0] for row in range(start, end + 1))
+        QApplication.clipboard().setText(text)
+
+    def paintEvent(self, event):
+        painter = QPainter(self.viewport())
+        lines = self.model.lines
+        formats = self.model.formats
+        metrics = self.model.metrics
+        first = self.verticalScrollBar().value()
+        last = min(len(lines), first + self.visible_lines() + 1)
+        if self.selection is not None:
+            selected_start, selected_end = sorted(self.selection)
+        else:
+            selected_start = selected_end = -1
+        right = self.viewport().width()
+        left = self.MARGIN - self.horizontalScrollBar().value()
+        content_width = self.content_width
+        for row in range(first, last):
+            y = (row - first) * self.line_height
+            if selected_start <= row <= selected_end:
+                painter.fillRect(
+                    0, y, right, self.line_height, self.palette().highlight()
+                )
+            text, runs = lines.get(row)
+            x = left
+            for i, (start, fmt_id) in enumerate(runs):
+                try:
+                    end = runs[i + 1][0]
+                except IndexError:
+                    end = len(text)
+                chunk = text[start:end]
+                advance = metrics[fmt_id].horizontalAdvance(chunk)
+                # Measure runs out of view, but only paint those in view:
+                if x < right and x + advance > 0:
+                    fmt = formats[fmt_id]
+                    painter.setFont(fmt.font())
+                    painter.setPen(fmt.foreground().color())
+                    painter.drawText(QPointF(x, y + metrics[fmt_id].ascent()), chunk)
+                x += advance
+            content_width = max(content_width, x - left)
+        painter.end()
+        if content_width > self.content_width:
+            self.content_width = content_width
+            self.update_horizontal_scrollbar()
+
+
+class RingBufferOutputBox(OutputBox):
+    """An OutputBox that keeps its scrollback in a LineRing, exposed as a LogModel and
+    displayed by a LogView, rather than in a QPlainTextEdit. This keeps memory use and
+    the cost of adding text low even with millions of lines of scrollback, at the cost
+    of no line wrapping, and text being selectable only as whole lines. The interface
+    is otherwise the same as OutputBox."""
+
+    def __init__(self, container, scrollback_lines=1000000, **kwargs):
+        OutputBox.__init__(self, container, scrollback_lines, **kwargs)
+
+    def _create_widget(self, container):
+        self.model = LogModel(self.scrollback_lines)
+        self.output_view = LogView(self.model)
+        self.model.setParent(self.output_view)
+        container.addWidget(self.output_view)
+        palette = self.output_view.palette()
+        palette.setColor(QPalette.ColorRole.Base, QColor(BACKGROUND))
+        self.output_view.setPalette(palette)
+        set_auto_scroll_to_end(self.output_view.verticalScrollBar())
+        return self.output_view
+
+    def _apply_plan(self, ops):
+        """Add text to the box according to a list of operations from _plan_text()"""
+        if not ops:
+            return
+        model = self.model
+        n_rows = len(model.lines)
+        # The lines being edited, as [text, runs] lists. The first is the existing last
+        # line, if any:
+        if n_rows:
+            text, runs = model.lines.get(n_rows - 1)
+            tail = [[text, list(runs)]]
+        else:
+            tail = [['', []]]
+        for linepos, text, charformat_repr in ops:
+            line = tail[-1]
+            if linepos == self.LINE_NEW:
+                # Like appendPlainText(), only start a new line if the box is not
+                # empty:
+                if n_rows > 1 or len(tail) > 1 or line[0]:
+                    line = ['', []]
+                    tail.append(line)
+            elif linepos == self.LINE_START:
+                line[:] = ['', []]
+            if text:
+                fmt_id = model.format_id(charformat_repr)
+                if not line[1] or line[1][-1][1] != fmt_id:
+                    line[1].append((len(line[0]), fmt_id))
+                line[0] += text
+        lines = [(text, model.compact_runs(runs)) for text, runs in tail]
+        if n_rows:
+            if lines[0] != model.lines.get(n_rows - 1):
+                model.set_last_line(*lines[0])
+            del lines[0]
+        elif lines == [('', ())]:
+            # Still empty
+            return
+        if lines:
+            model.append_lines(lines)
+
+
+class OutputBoxHandler(logging.Handler):
+    """A logging handler that prints records to an OutputBox, in the FORMAT_ALIASES
+    charformat for their level. Records are put in a queue, and formatted and written
+    to the OutputBox by a background thread, with consecutive records of the same
+    charformat written together as a single message. This keeps the cost of logging
+    low for the thread making the logging call. However, it means that arguments of a
+    logging call that are modified soon after the call may be formatted with their
+    modified values.
+
+    close() prints any records still queued and stops the thread. It is called at
+    interpreter exit by the logging module. Records logged after the OutputBox is
+    shut down are discarded."""
+
+    # Standard levels, highest first, and their charformats:
+    LEVEL_CHARFORMATS = [
+        (logging.CRITICAL, 'CRITICAL'),
+        (logging.ERROR, 'ERROR'),
+        (logging.WARNING, 'WARNING'),
+        (logging.INFO, 'INFO'),
+        (logging.DEBUG, 'DEBUG'),
+    ]
+
+    # Max number of records to write to the OutputBox as a single message:
+    MAX_RECORDS_BATCH = 1000
+
+    def __init__(self, output_box, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.output_box = output_box
+        self.queue = queue.SimpleQueue()
+        self.closed = False
+        self.thread = threading.Thread(target=self.mainloop, name='OutputBoxHandler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        self.queue.put(record)
+
+    def charformat(self, record):
+        """Return the charformat with which to print the record: that of the highest
+        standard level not above the record's level"""
+        for level, charformat in self.LEVEL_CHARFORMATS:
+            if record.levelno >= level:
+                return charformat
+        return 'DEBUG'
+
+    def flush(self):
+        """Wait until all records logged so far have been written to the OutputBox"""
+        with self.lock:
+            if self.closed:
+                return
+            flushed = threading.Event()
+            self.queue.put(flushed)
+        # Don't wait forever if the thread has somehow died:
+        while not flushed.wait(0.1):
+            if not self.thread.is_alive():
+                return
+
+    def close(self):
+        """Write all records logged so far to the OutputBox, and stop the background
+        thread"""
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.queue.put(None)
+                self.thread.join()
+        logging.Handler.close(self)
+
+    def mainloop(self):
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.MAX_RECORDS_BATCH:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = []
+            lines = []
+            current_charformat = None
+            for item in items:
+                if item is None or isinstance(item, threading.Event):
+                    # close() or flush(). Write what we have so far first:
+                    self._write(records, lines, current_charformat)
+                    records = []
+                    lines = []
+                    if item is None:
+                        return
+                    item.set()
+                    continue
+                try:
+                    text = self.format(item)
+                    charformat = self.charformat(item)
+                except Exception:
+                    self.handleError(item)
+                    continue
+                if charformat != current_charformat:
+                    self._write(records, lines, current_charformat)
+                    records = []
+                    lines = []
+                    current_charformat = charformat
+                records.append(item)
+                lines.append(text)
+            self._write(records, lines, current_charformat)
+
+    def _write(self, records, lines, charformat):
+        """Write the formatted lines of the records to the OutputBox, passing the
+        records to handleError() if this fails"""
+        # Writes to a shut down OutputBox block once its socket is full, so don't:
+        if not lines or self.output_box._receiver_done.is_set():
+            return
+        try:
+            self.output_box.write('\n'.join(lines) + '\n', charformat=charformat)
+        except Exception:
+            for record in records:
+                self.handleError(record)
+
+
 if __name__ == '__main__':
     import sys
     app = QApplication(sys.argv)
@@ -397,6 +1514,15 @@ if __name__ == '__main__':
     output_box.print("This should overwrite with print and then move on to the next line")
 
 
+    logger = logging.getLogger('qtutils.outputbox.demo')
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(OutputBoxHandler(output_box))
+    logger.debug('DEBUG log message via OutputBoxHandler')
+    logger.info('INFO log message via OutputBoxHandler')
+    logger.warning('WARNING log message via OutputBoxHandler')
+    logger.error('ERROR log message via OutputBoxHandler')
+    logger.critical('CRITICAL log message via OutputBoxHandler')
+
     # Uncomment to test this. Requires zprocess:
     # import logging
     # from zprocess import RichStreamHandler, rich_print # Requires zprocess 2.5.1
@@ -0,0 +1,165 @@
+#####################################################################
+#                                                                   #
+# watchdog.py                                                       #
+#                                                                   #
+# Copyright 2013, Christopher Billington, Philip Starkey            #
+#                                                                   #
+# This file is part of the qtutils project                          #
+# (see https://github.com/philipstarkey/qtutils )                   #
+# and is licensed under the 2-clause, or 3-clause, BSD License.     #
+# See the license.txt file in the root of the project               #
+# for the full license.                                             #
+#                                                                   #
+#####################################################################
+
+import sys
+import time
+import logging
+import threading
+import traceback
+
+from qtutils.qt.QtCore import QTimer
+from qtutils.invoke_in_main import inmain, caller, _qualified_name
+from qtutils.locking import blocker
+
+
+class MainLoopWatchdog(object):
+    """Detects when the Qt main loop has not returned to the event loop for longer than
+    a threshold, and reports what the main thread was doing.
+
+    A QTimer in the main thread records a heartbeat every :code:`interval` seconds,
+    and a daemon thread checks every :code:`interval` seconds how long ago the last
+    heartbeat was. Once per stall, when this exceeds :code:`threshold`, a report is
+    made containing the main thread's Python stack, the function call queued with
+    :func:`qtutils.invoke_in_main.inmain` (or related functions) that was running, if
+    any, and whether the main loop was blocked by :code:`qtutils.locking.qtlock`. In
+    either of the latter cases, the name and stack of the thread that requested the
+    call or block is included too.
+
+    Arguments:
+        threshold: How long, in seconds, the main loop must be unresponsive before a
+                   stall is reported.
+
+        interval: How often, in seconds, to record and check the heartbeat. Defaults
+                  to a quarter of the threshold.
+
+        callback: A function to be called, in the watchdog thread, with a dict
+                  describing each stall. If None, stalls are logged as warnings
+                  to :code:`logger` instead.
+
+        logger: The logger to use if no callback is given. Defaults to the
+                :code:`qtutils.watchdog` logger.
+    """
+
+    def __init__(self, threshold=2.0, interval=None, callback=None, logger=None):
+        if interval is None:
+            interval = threshold / 4
+        self.threshold = threshold
+        self.interval = interval
+        self.callback = callback
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        self.logger = logger
+        self.heartbeat = time.monotonic()
+        self.timer = None
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        """Start monitoring the main loop. May be called from any thread."""
+        if self.thread is not None:
+            raise RuntimeError('watchdog already started')
+        self.stopping.clear()
+        inmain(self._start_timer)
+        self.thread = threading.Thread(target=self.mainloop, name='MainLoopWatchdog')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop monitoring the main loop. May be called from any thread."""
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        inmain(self._stop_timer)
+
+    def _start_timer(self):
+        self.heartbeat = time.monotonic()
+        self.timer = QTimer()
+        self.timer.timeout.connect(self._beat)
+        self.timer.start(max(1, int(round(1000 * self.interval))))
+
+    def _stop_timer(self):
+        self.timer.stop()
+        self.timer = None
+
+    def _beat(self):
+        self.heartbeat = time.monotonic()
+
+    def mainloop(self):
+        stalled = False
+        while not self.stopping.wait(self.interval):
+            lag = time.monotonic() - self.heartbeat
+            if lag < self.threshold:
+                stalled = False
+            elif not stalled:
+                # Only report each stall once:
+                stalled = True
+                self.report(self.make_report(lag))
+
+    def make_report(self, duration):
+        """Return a dict describing what the main thread is currently doing."""
+        frames = sys._current_frames()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        main_ident = threading.main_thread().ident
+
+        def stack(ident):
+            frame = frames.get(ident)
+            if frame is None:
+                return None
+            return ''.join(traceback.format_stack(frame))
+
+        report = {
+            'duration': duration,
+            'main_thread_stack': stack(main_ident),
+            'call': None,
+            'block': None,
+        }
+        # Read these once each, since they may change under us:
+        call_event = caller.current_event
+        block_event = blocker.current_event
+        if call_event is not None:
+            report['call'] = {
+                'function': _qualified_name(call_event.fn),
+                'thread': names.get(call_event.thread_ident),
+                'thread_stack': stack(call_event.thread_ident),
+            }
+        if block_event is not None:
+            report['block'] = {
+                'thread': names.get(block_event.thread_ident),
+                'thread_stack': stack(block_event.thread_ident),
+            }
+        return report
+
+    def report(self, report):
+        """Pass a report to the callback, or log it if there is no callback."""
+        if self.callback is not None:
+            self.callback(report)
+            return
+        lines = [
+            'Main loop unresponsive for %.1f seconds. Main thread stack:' % report['duration'],
+            report['main_thread_stack'] or '  (unavailable)\n',
+        ]
+        if report['call'] is not None:
+            call = report['call']
+            lines.append(
+                'Running %s, requested by thread %s, whose stack is:'
+                % (call['function'], call['thread'])
+            )
+            lines.append(call['thread_stack'] or '  (thread has exited)\n')
+        if report['block'] is not None:
+            block = report['block']
+            lines.append('Blocked by qtlock held by thread %s, whose stack is:' % block['thread'])
+            lines.append(block['thread_stack'] or '  (thread has exited)\n')
+        self.logger.warning('\n'.join(line.rstrip('\n') for line in lines))